@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.split(__file__)[0], '..')))
+
+from mdt import api, packages, repository
+
+SIZES = [10, 1000, 10000]
+RUNS = 30
+# install and uninstall run real scripts, so they get fewer rounds
+SLOW_RUNS = 10
+# share of the repository that is installed in the synthetic install tree
+INSTALLED = 0.1
+WORDS = ['mod', 'tool', 'pack', 'texture', 'shader', 'map', 'sound', 'editor', 'server', 'client', 'lib', 'util']
+NOOP = 'import sys\n'
+
+
+def write_package(d: str, name: str, versions: list, rng: random.Random):
+    os.makedirs(d)
+    manifest = {
+        'name': name,
+        'description': ' '.join(rng.sample(WORDS, 3)),
+        'versions': versions,
+        'default-version': versions[-1],
+        'icon': None,
+        'install-script': 'install.py',
+        'remove-script': 'remove.py',
+        'start-script': 'start.py',
+        'add-launcher': False
+    }
+    with open(os.path.join(d, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    for script in ('install.py', 'remove.py', 'start.py'):
+        with open(os.path.join(d, script), 'w') as f:
+            f.write(NOOP)
+    return manifest
+
+
+def generate(root: str, size: int, seed: int = 0):
+    # a source tree of size packages with 1 to 8 versions each, plus an install tree holding INSTALLED of them
+    rng = random.Random(seed)
+    for d in ('repository', '.tmp', os.path.join('installed-programs', 'package-data'), os.path.join('installed-programs', 'program-data')):
+        os.makedirs(os.path.join(root, d))
+    source = os.path.join(root, 'source')
+    manifests = []
+    for n in range(size):
+        name = f'{rng.choice(WORDS)}-{rng.choice(WORDS)}-{n}'
+        versions = [f'{major}.{minor}.0' for major in range(1, 3) for minor in range(4)][:rng.randint(1, 8)]
+        manifests.append(write_package(os.path.join(source, name), name, versions, rng))
+    config = {}
+    for manifest in rng.sample(manifests, max(1, int(size * INSTALLED))):
+        package_dir = os.path.join(root, 'installed-programs', 'package-data', str(uuid.uuid4()))
+        program_dir = os.path.join(root, 'installed-programs', 'program-data', str(uuid.uuid4()))
+        installed = write_package(package_dir, manifest['name'], manifest['versions'], rng)
+        installed['version'] = manifest['default-version']
+        installed['program-dir'] = program_dir
+        del installed['versions']
+        del installed['default-version']
+        with open(os.path.join(package_dir, 'manifest.json'), 'w') as f:
+            json.dump(installed, f)
+        os.mkdir(program_dir)
+        config[installed['name']] = installed['version']
+    with open(os.path.join(root, 'installed-programs', 'package-data', 'version-config.json'), 'w') as f:
+        json.dump(config, f)
+    return source, manifests, sorted(config)
+
+
+def timed(func, runs: int, setup=None):
+    times = []
+    for _ in range(runs):
+        if setup is not None:
+            setup()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def summarize(times: list):
+    ordered = sorted(times)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] * 1000
+
+    return {
+        'runs': len(times),
+        'mean-ms': statistics.mean(times) * 1000,
+        'p50-ms': percentile(50),
+        'p90-ms': percentile(90),
+        'p99-ms': percentile(99),
+        'max-ms': ordered[-1] * 1000,
+        'ops-per-s': len(times) / sum(times) if sum(times) else None
+    }
+
+
+def bench_size(size: int, runs: int, seed: int):
+    results = {}
+    with tempfile.TemporaryDirectory() as root:
+        source, manifests, installed = generate(root, size, seed)
+        rng = random.Random(seed)
+        a = api.Api(root, verbose=False, config={'launch-mode': 'inprocess'})
+        repo_path = os.path.join(root, 'repository')
+        installed_path = os.path.join(root, 'installed-programs')
+        index_files = [repo_path + '.index.json', repository.search_index_path(repo_path),
+                       os.path.join(installed_path, 'package-index.json'), os.path.join(installed_path, 'launch-cache.json')]
+
+        def drop_indexes():
+            for p in index_files:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(p)
+
+        results['update'] = timed(lambda: a.update(source, clear=True), 1)
+        results['repository-load-cold'] = timed(lambda: repository.Repository(repo_path), min(runs, 5), drop_indexes)
+        results['repository-load'] = timed(lambda: repository.Repository(repo_path), runs)
+        results['installed-load-cold'] = timed(lambda: packages.Packages(installed_path), min(runs, 5), drop_indexes)
+        results['installed-load'] = timed(lambda: packages.Packages(installed_path), runs)
+        p = packages.Packages(installed_path)
+        results['get-installations-of'] = timed(lambda: p.get_installations_of(rng.choice(installed)), runs)
+        results['search'] = timed(lambda: a.search_packages(rng.choice(WORDS), limit=20), runs)
+        results['search-fuzzy'] = timed(lambda: a.search_packages(rng.choice(manifests)['name'][:-1] + 'x', limit=20), runs)
+        results['list'] = timed(a.list_installed, runs)
+        results['show'] = timed(lambda: a.show(rng.choice(installed)), runs)
+        results['run'] = timed(lambda: a.run(rng.choice(installed)), runs)
+        results['export'] = timed(lambda: a.export(os.path.join(root, 'export')), 1)
+        candidates = [m['name'] for m in manifests if m['name'] not in installed]
+        if candidates:
+            name = rng.choice(candidates)
+            results['install'] = []
+            results['uninstall'] = []
+            for _ in range(SLOW_RUNS):
+                results['install'] += timed(lambda: a.install(name), 1)
+                results['uninstall'] += timed(lambda: a.uninstall(name), 1)
+        results['update-unchanged'] = timed(lambda: a.update(source, clear=False), min(runs, 3))
+    return {op: summarize(times) for op, times in results.items()}
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.split(__file__)[0],
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results: dict, baseline_path: str):
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)['results']
+    for size, ops in results.items():
+        for op, stats in ops.items():
+            old = baseline.get(size, {}).get(op)
+            if old is None:
+                continue
+            change = (stats['p50-ms'] - old['p50-ms']) / old['p50-ms'] * 100 if old['p50-ms'] else 0
+            print(f'{size:>8} {op:<24} {old["p50-ms"]:>10.2f} -> {stats["p50-ms"]:>10.2f} ms p50 ({change:+.1f}%)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='time mdt operations on synthetic repositories')
+    parser.add_argument('--sizes', default=','.join(str(s) for s in SIZES), help='comma separated package counts')
+    parser.add_argument('--runs', type=int, default=RUNS, help='rounds per fast operation')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args()
+    results = {}
+    for size in [int(s) for s in args.sizes.split(',')]:
+        print(f'{size} packages')
+        results[str(size)] = bench_size(size, args.runs, args.seed)
+        for op, stats in results[str(size)].items():
+            print(f'    {op:<24} p50 {stats["p50-ms"]:>10.2f} ms   p90 {stats["p90-ms"]:>10.2f} ms   p99 {stats["p99-ms"]:>10.2f} ms   '
+                  f'{stats["ops-per-s"]:>10.1f} ops/s')
+    if args.compare:
+        compare(results, args.compare)
+    if args.output:
+        data = {
+            'commit': commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results
+        }
+        with open(args.output, 'w') as f:
+            json.dump(data, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
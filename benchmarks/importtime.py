@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.split(__file__)[0], '..'))
+# what main.py imports before it knows which command runs
+STATEMENT = 'import mdt.api, mdt.argument_parser'
+RUNS = 10
+BUDGET_MS = 30
+# only network, update, install and daemon commands may load these
+LAZY = ('requests', 'urllib3', 'zipfile', 'concurrent.futures', 'hashlib', 'uuid', 'subprocess', 'shutil', 'tempfile',
+        'socket', 'mdt.cache', 'mdt.extract', 'mdt.runner', 'mdt.daemon')
+
+
+def measure():
+    # bytecode has to be written, compiling the sources would dominate every run
+    env = {k: v for k, v in os.environ.items() if k != 'PYTHONDONTWRITEBYTECODE'}
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', STATEMENT], cwd=ROOT, env=env,
+                            stderr=subprocess.PIPE, text=True, check=True).stderr
+    total = 0
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # everything up to and including site is interpreter startup
+        if name.strip() == 'site':
+            modules = []
+            total = 0
+            continue
+        modules.append(name.strip())
+        if not name.startswith('  '):
+            total += int(cumulative)
+    return total / 1000, modules
+
+
+def loaded_modules():
+    # without site (-S), .pth hooks may preload modules such as shutil and would hide them from the check
+    return subprocess.run([sys.executable, '-S', '-c', STATEMENT + '; import sys; print("\\n".join(sys.modules))'], cwd=ROOT,
+                          stdout=subprocess.PIPE, text=True, check=True).stdout.split()
+
+
+def main():
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else BUDGET_MS
+    # the first run writes the bytecode, it is not counted
+    measure()
+    times = []
+    for _ in range(RUNS):
+        ms, _ = measure()
+        times.append(ms)
+    modules = loaded_modules()
+    loaded = [m for m in LAZY if m in modules]
+    median = statistics.median(times)
+    if loaded:
+        print(f'FAIL: {", ".join(loaded)} imported on startup')
+        sys.exit(1)
+    if median > budget:
+        print(f'FAIL: imports take {median:.1f} ms, the budget is {budget:.1f} ms')
+        sys.exit(1)
+    print(f'OK: imports take {median:.1f} ms (min {min(times):.1f}, max {max(times):.1f}), budget {budget:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import sys
+import tempfile
+from multiprocessing import Process
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.split(__file__)[0], '..')))
+
+from mdt.packages import VersionConfig
+
+PROCESSES = 8
+EDITS = 200
+
+
+def worker(path: str, number: int):
+    for i in range(EDITS):
+        VersionConfig.edit(path, {'name': f'package-{number}-{i % 10}', 'version': str(i)})
+        if i % 3 == 0:
+            VersionConfig.remove(path, f'package-{number}-{(i + 5) % 10}')
+
+
+def main():
+    with tempfile.TemporaryDirectory() as root:
+        os.mkdir(os.path.join(root, 'package-data'))
+        with open(os.path.join(root, 'package-data', 'version-config.json'), 'w') as f:
+            json.dump({}, f)
+        processes = [Process(target=worker, args=(root, n)) for n in range(PROCESSES)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        config = VersionConfig.get_config(root)
+        if config is None:
+            print('FAIL: version-config.json is corrupt')
+            sys.exit(1)
+        # every process ends with a deterministic set of entries, lost updates show up as missing ones
+        expected = set()
+        for n in range(PROCESSES):
+            names = set()
+            for i in range(EDITS):
+                name = f'package-{n}-{i % 10}'
+                if i % 3 == 0:
+                    names.discard(f'package-{n}-{(i + 5) % 10}')
+                names.add(name)
+            expected |= names
+        found = set(config)
+        if found != expected:
+            print(f'FAIL: expected {len(expected)} entries, found {len(found)}')
+            sys.exit(1)
+        print(f'OK: {PROCESSES} processes x {EDITS} edits, {len(found)} entries consistent')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,24 @@
 #!/usr/bin/env python3
 
+import atexit
 import json
 import os
 import sys
 
 import mdt
+# imported by name, not through mdt's lazy attribute access, so PyInstaller (build.py) finds and bundles them
+import mdt.api
+import mdt.argument_parser
+import mdt.tracing
 
 __VERSION__ = '1.0.0'
 PATH = os.path.abspath(os.path.split(__file__)[0])
+# written once the directory layout has been checked, so later runs skip the checks with a single stat
+SETUP_MARKER = os.path.join(PATH, '.tmp', 'setup-verified')
 
 OPTIONS = {
     'install': {
-        'arg': {'type': str, 'required': True, 'store-to': 'package', 'help-keyword': 'package'},
+        'arg': {'type': str, 'required': True, 'multiple': True, 'store-to': 'package', 'help-keyword': 'package'},
         'options': [
             {'keys': ['-v', '--version'], 'arg': True, 'store-to': 'version', 'type': str, 'help': 'version to install'},
             {'keys': ['-r', '--reinstall'], 'arg': False, 'store-to': 'reinstall', 'type': None, 'help': 'reinstall program'}
@@ -51,9 +58,34 @@ OPTIONS = {
         'arg': {'type': str, 'required': True, 'store-to': 'package', 'help-keyword': 'package'},
         'options': []
     },
+    'daemon': {
+        'arg': {'type': str, 'required': True, 'store-to': 'action', 'help-keyword': 'action'},
+        'options': []
+    },
+    'metrics': {
+        'arg': None,
+        'options': [
+            {'keys': ['-f', '--format'], 'arg': True, 'store-to': 'format', 'type': str, 'help': 'prometheus or json'},
+            {'keys': ['-o', '--output'], 'arg': True, 'store-to': 'output', 'type': str, 'help': 'file to write to'}
+        ]
+    },
+    'fsck': {
+        'arg': None,
+        'options': []
+    },
     'search': {
         'arg': {'type': str, 'required': True, 'store-to': 'search_string', 'help-keyword': 'search-string'},
-        'options': []
+        'options': [
+            {'keys': ['-l', '--limit'], 'arg': True, 'store-to': 'limit', 'type': int, 'help': 'maximum number of results'}
+        ]
+    },
+    'cache': {
+        'arg': {'type': str, 'required': True, 'store-to': 'action', 'help-keyword': 'action'},
+        'options': [
+            {'keys': ['-u', '--url'], 'arg': True, 'store-to': 'url', 'type': str, 'help': 'url to fetch'},
+            {'keys': ['-s', '--sha256'], 'arg': True, 'store-to': 'sha256', 'type': str, 'help': 'expected sha256 of the artifact'},
+            {'keys': ['-m', '--max-size'], 'arg': True, 'store-to': 'max_size', 'type': float, 'help': 'size to prune to in MiB'}
+        ]
     },
     'update': {
         'arg': {'type': str, 'required': False, 'store-to': 'update_url', 'help-keyword': 'url'},
@@ -65,7 +97,7 @@ OPTIONS = {
 HELP = f'''
 Commands. COMMAND [arg] <OPTIONAL> [flags]
 
-install [package] <install package>:
+install [package ...] <install packages in parallel>:
     -v, --version [version] | version of package to install
     -r, --reinstall | reinstall if already installed
 
@@ -87,11 +119,29 @@ repo <update and export package repository>:
     
 config [package] <configure default version for package>
 
-search [search-string] <search repository for packages>
+search [search-string] <search repository for packages, best matches first>
+    -l, --limit [number] | maximum number of results
 
 update [update-url] <update repository from url>
     -c, --clear | clear repository before updating
 
+daemon [start|stop|status|run] <resident process answering list, show, search and run from memory>
+
+metrics <operation counts, durations, failures and download volume of this machine>
+    -f, --format [prometheus|json] | output format, defaults to prometheus
+    -o, --output [file] | write to file instead of stdout, e.g. for the node_exporter textfile collector
+
+fsck <finish interrupted operations and remove orphaned installation data>
+
+cache [stats|prune|fetch] <manage the shared download cache>
+    -u, --url [url] | fetch: url of the artifact
+    -s, --sha256 [hash] | fetch: expected sha256, a cached copy is used when present
+    -m, --max-size [MiB] | prune: size to prune to, defaults to the configured cache-size
+
+Global flags, accepted by every command:
+    --timings | print the time spent in each phase to stderr
+    --trace [file] | write a Chrome trace (chrome://tracing, Perfetto) of the command to file
+
 '''
 VERSION = f' - Mod Development Tool -\n   Version: {__VERSION__} Beta'
 with open(os.path.join(os.path.abspath(os.path.split(__file__)[0]), 'config.json'), 'r') as f:
@@ -153,7 +203,52 @@ class InputProcessor:
                 sys.exit(0)
             self._api.configure(self._commands.config.package)
         elif self._commands.search:
-            self._api.search_packages(self._commands.search.search_string)
+            if self._commands.search.limit:
+                try:
+                    limit = int(self._commands.search.limit)
+                except ValueError:
+                    print('Invalid limit.')
+                    sys.exit(0)
+                self._api.search_packages(self._commands.search.search_string, limit)
+            else:
+                self._api.search_packages(self._commands.search.search_string)
+        elif self._commands.daemon:
+            if self._commands.daemon.action in ('start', 'stop', 'run') and os.geteuid() != 0 and self._root is True:
+                print('You must be root to run this command')
+                sys.exit(0)
+            self._api.daemon_control(self._commands.daemon.action)
+        elif self._commands.metrics:
+            if type(self._commands.metrics) is bool:
+                self._api.metrics_report()
+            else:
+                self._api.metrics_report(self._commands.metrics.format or 'prometheus', self._commands.metrics.output or None)
+        elif self._commands.fsck:
+            if os.geteuid() != 0 and self._root is True:
+                print('You must be root to run this command')
+                sys.exit(0)
+            self._api.fsck()
+        elif self._commands.cache:
+            action = self._commands.cache.action
+            if action == 'stats':
+                self._api.cache_stats()
+            elif action == 'prune':
+                if os.geteuid() != 0 and self._root is True:
+                    print('You must be root to run this command')
+                    sys.exit(0)
+                try:
+                    max_size = float(self._commands.cache.max_size) if self._commands.cache.max_size else None
+                except ValueError:
+                    print('Invalid size.')
+                    sys.exit(0)
+                self._api.cache_prune(max_size)
+            elif action == 'fetch' and self._commands.cache.url:
+                if os.geteuid() != 0 and self._root is True:
+                    print('You must be root to run this command')
+                    sys.exit(0)
+                print(self._api.cache_fetch(self._commands.cache.url, self._commands.cache.sha256 or None))
+            else:
+                print('Invalid usage')
+                print(HELP)
         elif self._commands.update:
             if os.geteuid() != 0 and self._root is True:
                 print('You must be root to run this command')
@@ -182,7 +277,35 @@ def setup():
         os.mkdir(os.path.join(PATH, '.tmp'))
     if not os.path.isfile(os.path.join(PATH, 'installed-programs', 'package-data', 'version-config.json')):
         with open(os.path.join(PATH, 'installed-programs', 'package-data', 'version-config.json'), 'w') as f:
-            json.dump([], f, indent=2)
+            json.dump({}, f, indent=2)
+    with open(SETUP_MARKER, 'w') as f:
+        f.write(__VERSION__)
+
+
+def tracing_options():
+    # --timings and --trace [file] work with every command and are taken out before the command is parsed
+    timings = False
+    trace = None
+    args = sys.argv[:1]
+    i = 1
+    while i < len(sys.argv):
+        if sys.argv[i] == '--timings':
+            timings = True
+        elif sys.argv[i] == '--trace' and i + 1 < len(sys.argv):
+            trace = sys.argv[i + 1]
+            i += 1
+        else:
+            args.append(sys.argv[i])
+        i += 1
+    sys.argv[:] = args
+    return timings, trace
+
+
+def report_tracing(timings: bool, trace: str):
+    if timings:
+        print(mdt.tracing.summary(), file=sys.stderr)
+    if trace:
+        mdt.tracing.write_chrome_trace(trace)
 
 
 def check_setup():
@@ -202,20 +325,45 @@ def check_setup():
     return ret
 
 
-if __name__ == '__main__':
-    if CONFIG['root'] is True and os.geteuid() == 0:
-        setup()
-    elif CONFIG['root'] is False:
+def ensure_setup(writable: bool):
+    if writable:
         setup()
-    else:
-        valid = check_setup()
-        if valid is False:
-            print('ERR: Missing directories. Run as root to rebuild them.')
-            sys.exit(0)
-    package_api = mdt.api.Api(PATH, verbose=True)
+    elif check_setup() is False:
+        print('ERR: Missing directories. Run as root to rebuild them.')
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    timings, trace = tracing_options()
+    if timings or trace:
+        mdt.tracing.enable()
+        # also runs when a command ends with sys.exit()
+        atexit.register(report_tracing, timings, trace)
+        # exec replaces the process before atexit handlers run, so a traced run keeps mdt alive
+        if CONFIG.get('launch-mode') == 'exec':
+            CONFIG['launch-mode'] = 'subprocess'
+    writable = (CONFIG['root'] is True and os.geteuid() == 0) or CONFIG['root'] is False
+    if not os.path.isfile(SETUP_MARKER):
+        ensure_setup(writable)
+    package_api = mdt.api.Api(PATH, verbose=True, config=CONFIG)
     command_list = mdt.argument_parser.Parser(OPTIONS, VERSION, HELP).get_parsed()
     processor = InputProcessor(command_list, package_api, root=CONFIG['root'])
-    processor.run()
+    for attempt in range(2):
+        try:
+            if writable:
+                # installs and uninstalls killed half way are finished or undone before anything else runs
+                package_api.recover()
+            processor.run()
+            break
+        except OSError:
+            # the marker may have outlived a directory removed since, the layout is checked again only now
+            if attempt == 1 or check_setup():
+                raise
+            try:
+                os.remove(SETUP_MARKER)
+            except OSError:
+                pass
+            ensure_setup(writable)
 
 
 
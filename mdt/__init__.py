@@ -1,6 +1,12 @@
 #!/usr/bin/env python3
 
-from . import repository
-from . import packages
-from . import api
-from . import argument_parser
+import importlib
+
+# submodules are imported on first use, so a command only pays for the modules it touches
+__all__ = ['repository', 'packages', 'api', 'argument_parser', 'tracing']
+
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -2,31 +2,44 @@
 
 import json
 import os
-import shutil
-import subprocess
 import sys
-import requests
-from zipfile import ZipFile
+import time
 
+from . import launch
+from . import metrics
 from . import repository
 from . import packages
+from .fileio import write_json_atomic
+from .tracing import span, traced
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 256
 
 
 class Api:
 
-    def __init__(self, path: str, verbose: bool = False):
+    def __init__(self, path: str, verbose: bool = False, config: dict = None):
         self._path = path
         self._verbose = verbose
+        self._config = config or {}
+        self._daemon = None
 
-    def install(self, name: str, version: str = None):
-        packages.install(package_name=name, version=version, path=self._path, verbose=self._verbose)
+    def install(self, name, version: str = None):
+        names = name if type(name) is list else [name]
+        return packages.install_many(names, version=version, path=self._path, verbose=self._verbose,
+                                     workers=self._config.get('workers'), dedup=self._config.get('dedup', 'off'),
+                                     package_mode=self._config.get('package-mode', 'copy'),
+                                     script_timeout=self._config.get('script-timeout'))
 
     def uninstall(self, name: str, version: str = None):
-        packages.uninstall(package_name=name, version=version, path=self._path, verbose=self._verbose)
+        packages.uninstall(package_name=name, version=version, path=self._path, verbose=self._verbose,
+                           script_timeout=self._config.get('script-timeout'))
 
     def show(self, package: str, version: str = None):
-        packs = packages.Packages(os.path.join(self._path, 'installed-programs'))
-        installed = packs.get_installations_of(package)
+        response = self._daemon_request('installations', name=package)
+        if response is not None:
+            installed = response['result']
+        else:
+            installed = packages.Packages(os.path.join(self._path, 'installed-programs')).get_installations_of(package)
         for i in installed:
             if version:
                 if i['version'] == version:
@@ -35,13 +48,20 @@ class Api:
                 print(f'Name: {i["name"]}\nVersion: {i["version"]}\n')
 
     def list_installed(self):
-        packs = packages.Packages(os.path.join(self._path, 'installed-programs'))
-        installed = packs.get_all_installed()
+        response = self._daemon_request('installed')
+        if response is not None:
+            installed = response['result']
+        else:
+            installed = packages.Packages(os.path.join(self._path, 'installed-programs')).get_all_installed()
         for i in installed:
             print(f'Name: {i["name"]}\nVersion: {i["version"]}\n')
 
-    def search_packages(self, search_string: str):
-        packs = packages.search(search_string, path=self._path)
+    def search_packages(self, search_string: str, limit: int = None):
+        response = self._daemon_request('search', query=search_string, limit=limit)
+        if response is not None:
+            packs = response['result']
+        else:
+            packs = packages.search(search_string, path=self._path, limit=limit)
         for p in packs:
             print(f'Name: {p["name"]}\nDefault Version: {p["default-version"]}\nOther Versions: {p["versions"]}')
 
@@ -72,50 +92,273 @@ class Api:
         packs.configure(name, new_config_version)
 
     def run(self, name: str, version: str = None):
-        packs = packages.Packages(os.path.join(self._path, 'installed-programs'))
-        if len(packs.get_installations_of(name)) == 0:
-            print(f'Program \'{name}\' could not be found.')
-            sys.exit(0)
+        # exec is opt-in (config.json sets it for the CLI), library callers keep their process
+        launch.launch(self._launch_plan(name, version), self._config.get('launch-mode', 'subprocess'))
+
+    @traced('run.resolve')
+    def _launch_plan(self, name: str, version: str = None):
+        installed = os.path.join(self._path, 'installed-programs')
+        if not version:
+            version = (packages.VersionConfig.get_config(installed) or {}).get(name)
+        cache = launch.LaunchCache(installed)
+        # a cached plan launches without loading the package index or reading a manifest
+        plan = cache.get(name, version) if version else None
+        if plan is None:
+            plan = self._resolve_launch(name, version, cache)
+        return plan
+
+    def _resolve_launch(self, name: str, version: str, cache):
+        stamp = cache.stamp()
+        response = self._daemon_request('plan', name=name, version=version)
         try:
-            version = version or packs.get_config_of(name)['version']
-        except TypeError or KeyError:
-            print('No default version. please specify.')
-            sys.exit(0)
-        path_to_manifest = packs.is_installed(name, version)
-        if path_to_manifest is None:
-            print(f'{name} has no version {version}.')
+            if response is None:
+                plan = launch.resolve(packages.Packages(os.path.join(self._path, 'installed-programs')), name, version)
+            elif 'error' in response['result']:
+                raise launch.LaunchError(response['result']['error'])
+            else:
+                plan = response['result']['plan']
+        except launch.LaunchError as e:
+            print(e)
             sys.exit(0)
-        with open(os.path.join(path_to_manifest)) as f:
-            manifest = json.load(f)
-        subprocess.call(['python3', os.path.join(os.path.split(path_to_manifest)[0], manifest['start-script']), manifest['program-dir'], manifest['version']])
+        cache.put(name, plan['version'], plan, stamp)
+        return plan
+
+    def daemon_control(self, action: str):
+        from . import daemon
+        running = daemon.Client(self._path).request('ping')
+        if action == 'status':
+            print(f'mdtd is running (pid {running["result"]["pid"]}).' if running else 'mdtd is not running.')
+        elif action == 'stop':
+            stopped = running and daemon.Client(self._path).request('stop')
+            print('mdtd stopped.' if stopped else 'mdtd is not running.')
+        elif running:
+            print(f'mdtd is already running (pid {running["result"]["pid"]}).')
+        elif action == 'start':
+            pid = daemon.start(self._path)
+            print(f'mdtd started (pid {pid}).' if pid else 'ERR: mdtd failed to start')
+        elif action == 'run':
+            print(f'mdtd listening on {daemon.socket_path(self._path)}')
+            try:
+                daemon.serve(self._path)
+            except KeyboardInterrupt:
+                pass
+        else:
+            print(f'Unknown action {action}.')
+
+    def _daemon_request(self, op: str, **args):
+        # read-only queries are answered by the resident daemon when one runs (see mdt.daemon),
+        # None means the caller has to work on the files directly; without the socket (mdt.daemon.socket_path)
+        # no daemon runs and neither the module nor socket is imported
+        if self._daemon is None and not os.path.exists(os.path.join(self._path, '.tmp', 'mdtd.sock')):
+            return None
+        from . import daemon
+        if self._daemon is None:
+            self._daemon = daemon.Client(self._path)
+        return self._daemon.request(op, **args)
 
     def update_from_url(self, url: str, clear: bool):
         print(f'Downloading repository from {url}...')
+        started = time.monotonic()
+        # a cleared update always refetches, otherwise the validators of the last fetch make it conditional
+        validators = self._get_update_state(url)
+        if clear:
+            validators = {'partial': validators.get('partial')}
         try:
-            update_file = requests.get(url, allow_redirects=True)
-            with open(os.path.join(self._path, '.tmp', 'repository-update.zip'), 'wb') as f:
-                f.write(update_file.content)
+            with span('update.download', url=url):
+                validators = self._download(url, os.path.join(self._path, '.tmp', 'repository-update.zip'), validators)
         except Exception as e:
+            metrics.Metrics(self._path).operation('download', started, e)
             if self._verbose:
                 print(f'ERR error downloading {url}')
                 sys.exit(0)
             else:
                 raise e
+        if validators is None:
+            print('Repository is already up to date.')
+            return
+        import shutil
+
+        from . import extract
         print(f'Extracting repository-update.zip...')
-        with ZipFile(os.path.join(self._path, '.tmp', 'repository-update.zip'), 'r') as zipf:
-            zipf.extractall(path=os.path.join(self._path, '.tmp'))
+        staging = os.path.join(self._path, '.tmp', 'staging')
+        shutil.rmtree(staging, ignore_errors=True)
+        try:
+            with span('update.extract'):
+                extract.extract(os.path.join(self._path, '.tmp', 'repository-update.zip'), staging, workers=self._config.get('workers'))
+        except extract.UnsafeArchiveError as e:
+            metrics.Metrics(self._path).operation('download', started, e)
+            os.remove(os.path.join(self._path, '.tmp', 'repository-update.zip'))
+            if self._verbose:
+                print(f'ERR: refusing to extract archive: {e}')
+                sys.exit(0)
+            else:
+                raise e
+        metrics.Metrics(self._path).operation('download', started)
         print('Installing update...')
-        self.update(os.path.join(self._path, '.tmp', 'repository'), clear=clear)
+        # staged packages are renamed into the repository instead of being copied a second time
+        self.update(os.path.join(staging, 'repository'), clear=clear, move=True)
         print('Cleaning up...')
         os.remove(os.path.join(self._path, '.tmp', 'repository-update.zip'))
-        shutil.rmtree(os.path.join(self._path, '.tmp', 'repository'))
+        shutil.rmtree(staging, ignore_errors=True)
+        del validators['partial']
+        self._set_update_state(url, validators)
         print('Done!')
 
-    def update(self, file: str, clear: bool):
-        r = repository.Repository(os.path.join(self._path, 'repository'))
-        r.update(file, clear=clear)
+    def _download(self, url: str, dst: str, validators: dict):
+        # requests alone takes longer to import than the rest of mdt, only network commands load it
+        import requests
+        # a partial download is kept as .part so an interrupted transfer can resume with a range request
+        part = dst + '.part'
+        offset = os.path.getsize(part) if os.path.isfile(part) else 0
+        headers = {}
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+            if validators.get('partial'):
+                headers['If-Range'] = validators['partial']
+        else:
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last-modified'):
+                headers['If-Modified-Since'] = validators['last-modified']
+        with requests.get(url, headers=headers, stream=True, allow_redirects=True, timeout=30) as response:
+            if response.status_code == 304:
+                return None
+            if response.status_code == 416:
+                os.remove(part)
+                return self._download(url, dst, validators)
+            response.raise_for_status()
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+            new_validators = {'etag': etag, 'last-modified': last_modified, 'partial': etag or last_modified}
+            if response.status_code != 206:
+                offset = 0
+                # remember what the partial file belongs to so a resume can be made conditional with If-Range
+                self._set_update_state(url, dict(validators, partial=new_validators['partial']))
+            total = response.headers.get('Content-Length')
+            total = int(total) + offset if total is not None else None
+            received = offset
+            start = last_report = time.monotonic()
+            with open(part, 'ab' if offset else 'wb') as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    received += len(chunk)
+                    now = time.monotonic()
+                    if now - last_report >= 0.5:
+                        last_report = now
+                        self._print_progress(received, total, (received - offset) / (now - start))
+            elapsed = max(time.monotonic() - start, 1e-6)
+            self._print_progress(received, total, (received - offset) / elapsed)
+            print('')
+        metrics.Metrics(self._path).inc('downloaded_bytes_total', received - offset)
+        os.replace(part, dst)
+        return new_validators
+
+    def _get_update_state(self, url: str):
+        try:
+            with open(os.path.join(self._path, 'update-state.json'), 'r') as f:
+                return json.load(f).get(url, {})
+        except Exception:
+            return {}
+
+    def _set_update_state(self, url: str, validators: dict):
+        try:
+            with open(os.path.join(self._path, 'update-state.json'), 'r') as f:
+                state = json.load(f)
+        except Exception:
+            state = {}
+        state[url] = validators
+        write_json_atomic(os.path.join(self._path, 'update-state.json'), state, indent=2)
+
+    @staticmethod
+    def _print_progress(received: int, total: int, rate: float):
+        if total:
+            progress = f'{received / 1048576:.1f}/{total / 1048576:.1f} MiB ({received * 100 // total}%)'
+        else:
+            progress = f'{received / 1048576:.1f} MiB'
+        print(f'\r    {progress} at {rate / 1048576:.2f} MiB/s', end='', flush=True)
+
+    def update(self, file: str, clear: bool, move: bool = False):
+        started = time.monotonic()
+        r = repository.Repository(os.path.join(self._path, 'repository'), workers=self._config.get('workers'))
+        try:
+            r.update(file, clear=clear, move=move)
+        except Exception as e:
+            metrics.Metrics(self._path).operation('update', started, e)
+            if not isinstance(e, repository.InvalidPackagesError):
+                raise e
+            if self._verbose:
+                for d, err in e.errors.items():
+                    print(f'ERR: {os.path.basename(d)}: {type(err).__name__} {err}')
+                print('Update failed!')
+                sys.exit(0)
+            else:
+                raise e
+        metrics.Metrics(self._path).operation('update', started)
+
+    def cache_fetch(self, url: str, sha256: str = None):
+        # helper for install scripts: returns the local path of the artifact, downloading it only on a cache miss
+        return self._cache().fetch(url, sha256)
+
+    def cache_stats(self):
+        stats = self._cache().stats()
+        max_size = f'{stats["max-size"] / 1048576:.1f} MiB' if stats['max-size'] is not None else 'unlimited'
+        hit_rate = f'{stats["hit-rate"] * 100:.1f}%' if stats['hit-rate'] is not None else '-'
+        print(f'Path: {stats["path"]}\nEntries: {stats["entries"]}\nSize: {stats["size"] / 1048576:.1f} MiB / {max_size}')
+        print(f'Hits: {stats["hits"]}\nMisses: {stats["misses"]}\nHit rate: {hit_rate}')
+
+    def cache_prune(self, max_size: float = None):
+        removed, freed = self._cache().prune(int(max_size * 1048576) if max_size is not None else None)
+        print(f'Removed {removed} artifact(s), freed {freed / 1048576:.1f} MiB.')
+
+    def _cache(self):
+        from . import cache
+        max_size = self._config.get('cache-size')
+        return cache.ArtifactCache(os.path.join(self._path, 'cache'), int(max_size * 1048576) if max_size is not None else None)
+
+    def recover(self):
+        for entry in packages.recover(self._path):
+            action = 'finished' if entry['op'] == 'uninstall' or entry['state'] == 'script-done' else 'rolled back'
+            if self._verbose:
+                print(f'Interrupted {entry["op"]} of {entry["name"]} {entry["version"]} {action}.')
+
+    def fsck(self):
+        report = packages.fsck(self._path)
+        if self._verbose:
+            print(f'Recovered operations: {report["recovered"]}\nBroken packages removed: {report["broken-packages"]}')
+            print(f'Orphaned program directories removed: {report["orphaned-programs"]}')
+            print(f'Stale default versions fixed: {report["stale-defaults"]}\nStale snapshot references: {report["stale-snapshots"]}')
+        return report
+
+    def metrics_report(self, fmt: str = 'prometheus', output: str = None):
+        data = metrics.Metrics(self._path).read()
+        # package counts and cache numbers are taken from the current state, the cache keeps its own counters
+        stats = self._cache().stats()
+        data['counters'].update({'cache_hits_total': stats['hits'], 'cache_misses_total': stats['misses']})
+        gauges = {
+            'repository_packages': len(repository.Repository(os.path.join(self._path, 'repository')).get()),
+            'installed_packages': len(packages.Packages(os.path.join(self._path, 'installed-programs')).get_all_installed()),
+            'cache_entries': stats['entries'],
+            'cache_size_bytes': stats['size']
+        }
+        if stats['hit-rate'] is not None:
+            gauges['cache_hit_ratio'] = stats['hit-rate']
+        if fmt == 'json':
+            text = json.dumps(dict(data, gauges=gauges), indent=2) + '\n'
+        else:
+            text = metrics.prometheus(data, gauges)
+        if output is None:
+            print(text, end='')
+        else:
+            # the textfile collector may read at any moment, so the file is replaced rather than rewritten
+            import tempfile
+
+            fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(output) + '.', dir=os.path.dirname(os.path.abspath(output)))
+            with os.fdopen(fd, 'w') as f:
+                f.write(text)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, output)
 
     def export(self, path: str):
-        r = repository.Repository(os.path.join(self._path, 'repository'))
+        r = repository.Repository(os.path.join(self._path, 'repository'), workers=self._config.get('workers'))
         r.export(path)
 
@@ -70,13 +70,29 @@ class Parser:
         ret_namespace = Namespace()
         di = self._options[opt]
 
+        def is_flag(token: str):
+            for o in di['options']:
+                if token in o['keys']:
+                    return True
+            return False
+
         def set_arg():
-            ret = False
+            ret = 0
             if di['arg'] is None:
                 pass
+            elif di['arg']['required'] is True and di['arg'].get('multiple') is True:
+                values = []
+                for token in self._command[1:]:
+                    if is_flag(token):
+                        break
+                    values.append(token)
+                if len(values) == 0:
+                    raise InvalidUsage
+                ret_namespace[di['arg']['store-to']] = values
+                ret = len(values)
             elif di['arg']['required'] is True:
                 ret_namespace[di['arg']['store-to']] = self._command[1]
-                ret = True
+                ret = 1
             else:
                 matches_flag = False
                 for o in di['options']:
@@ -88,7 +104,7 @@ class Parser:
                         break
                 if matches_flag is False:
                     ret_namespace[di['arg']['store-to']] = self._command[1]
-                    ret = True
+                    ret = 1
                 else:
                     ret_namespace[di['arg']['store-to']] = None
             return ret
@@ -122,9 +138,5 @@ class Parser:
                             except KeyError:
                                 ret_namespace[k['store-to']] = False
 
-        is_arg = set_arg()
-        if is_arg is True:
-            set_flags(2)
-        else:
-            set_flags(1)
+        set_flags(1 + set_arg())
         return ret_namespace
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import os
+import tempfile
+
+from .fileio import locked, write_json_atomic
+
+CHUNK_SIZE = 1024 * 256
+
+
+class ChecksumMismatchError(Exception):
+    pass
+
+
+class ArtifactCache:
+    # content addressed store: objects/<first two hex digits>/<sha256>, least recently used entries are
+    # evicted once the cache grows past max_size bytes
+
+    def __init__(self, path: str, max_size: int = None):
+        self._path = path
+        self._objects = os.path.join(path, 'objects')
+        self._max_size = max_size
+        os.makedirs(self._objects, exist_ok=True)
+
+    def path_of(self, digest: str):
+        return os.path.join(self._objects, digest[:2], digest)
+
+    def get(self, digest: str):
+        p = self.path_of(digest)
+        if not os.path.isfile(p):
+            self._count('misses')
+            return None
+        os.utime(p)
+        self._count('hits')
+        return p
+
+    def put(self, file: str, digest: str = None):
+        with open(file, 'rb') as src:
+            return self._store(iter(lambda: src.read(CHUNK_SIZE), b''), digest)
+
+    def fetch(self, url: str, digest: str = None):
+        if digest is not None:
+            cached = self.get(digest)
+            if cached is not None:
+                return cached
+        import requests
+        with requests.get(url, stream=True, allow_redirects=True, timeout=30) as response:
+            response.raise_for_status()
+            digest = self._store(response.iter_content(chunk_size=CHUNK_SIZE), digest)
+        return self.path_of(digest)
+
+    def stats(self):
+        entries = 0
+        size = 0
+        for _, p, st in self._entries():
+            entries += 1
+            size += st.st_size
+        counters = self._read_counters()
+        lookups = counters['hits'] + counters['misses']
+        return {
+            'path': self._path,
+            'entries': entries,
+            'size': size,
+            'max-size': self._max_size,
+            'hits': counters['hits'],
+            'misses': counters['misses'],
+            'hit-rate': counters['hits'] / lookups if lookups else None
+        }
+
+    def prune(self, max_size: int = None, keep: str = None):
+        max_size = self._max_size if max_size is None else max_size
+        if max_size is None:
+            return 0, 0
+        with locked(os.path.join(self._path, '.lock')):
+            entries = sorted(self._entries(), key=lambda e: e[2].st_mtime)
+            size = sum(st.st_size for _, _, st in entries)
+            removed = 0
+            freed = 0
+            for name, p, st in entries:
+                if size <= max_size:
+                    break
+                if name == keep:
+                    continue
+                try:
+                    os.remove(p)
+                except FileNotFoundError:
+                    continue
+                size -= st.st_size
+                freed += st.st_size
+                removed += 1
+        return removed, freed
+
+    def _store(self, chunks, digest: str = None):
+        h = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(prefix='.incoming.', dir=self._path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    h.update(chunk)
+                    f.write(chunk)
+            actual = h.hexdigest()
+            if digest is not None and actual != digest.lower():
+                raise ChecksumMismatchError(f'expected sha256 {digest}, got {actual}')
+            os.makedirs(os.path.dirname(self.path_of(actual)), exist_ok=True)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.path_of(actual))
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        if self._max_size is not None:
+            # the artifact just stored is never evicted, even when it alone exceeds the cap
+            self.prune(keep=actual)
+        return actual
+
+    def _entries(self):
+        for prefix in os.listdir(self._objects):
+            prefix_path = os.path.join(self._objects, prefix)
+            for name in os.listdir(prefix_path):
+                p = os.path.join(prefix_path, name)
+                try:
+                    yield name, p, os.stat(p)
+                except FileNotFoundError:
+                    continue
+
+    def _read_counters(self):
+        try:
+            with open(os.path.join(self._path, 'stats.json'), 'r') as f:
+                return json.load(f)
+        except Exception:
+            return {'hits': 0, 'misses': 0}
+
+    def _count(self, key: str):
+        try:
+            with locked(os.path.join(self._path, '.lock')):
+                counters = self._read_counters()
+                counters[key] += 1
+                write_json_atomic(os.path.join(self._path, 'stats.json'), counters)
+        except OSError:
+            pass
+
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+# a wedged daemon must not hang the CLI, requests fall back to direct mode after this many seconds
+TIMEOUT = 2
+
+
+class AlreadyRunningError(Exception):
+    pass
+
+
+def socket_path(path: str):
+    return os.path.join(path, '.tmp', 'mdtd.sock')
+
+
+class State:
+    # parsed repository, installed packages and search index, rebuilt only when the repository or
+    # package-data directory mtime changes; both change with every update, install, uninstall and config edit
+
+    def __init__(self, path: str):
+        self._path = path
+        self._repo_path = os.path.join(path, 'repository')
+        self._installed_path = os.path.join(path, 'installed-programs')
+        self._stamps = (None, None)
+        self.lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        from .packages import Packages
+        from .repository import Repository, search_index_path
+        from .search import SearchIndex, build_index, load_index
+
+        # stamps are taken before reading so a change made while rebuilding triggers another rebuild
+        stamps = (os.stat(self._repo_path).st_mtime_ns, os.stat(os.path.join(self._installed_path, 'package-data')).st_mtime_ns)
+        if stamps[0] != self._stamps[0]:
+            self.repository = Repository(self._repo_path)
+            self.search = load_index(search_index_path(self._repo_path), self._repo_path) or SearchIndex(build_index(self.repository.get()))
+        if stamps[1] != self._stamps[1]:
+            self.packages = Packages(self._installed_path)
+        self._stamps = stamps
+
+    def handle(self, op: str, args: dict):
+        from .launch import LaunchError, resolve
+
+        if op == 'ping':
+            return {'pid': os.getpid()}
+        if op == 'installed':
+            return self.packages.get_all_installed()
+        if op == 'installations':
+            return self.packages.get_installations_of(args['name'])
+        if op == 'search':
+            return self.search.search(args['query'], args.get('limit'))
+        if op == 'plan':
+            try:
+                return {'plan': resolve(self.packages, args['name'], args.get('version'))}
+            except LaunchError as e:
+                return {'error': str(e)}
+        raise ValueError(f'unknown operation {op}')
+
+
+def _peer_uid(conn):
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    return struct.unpack('3i', creds)[1]
+
+
+def serve(path: str):
+    import socketserver
+
+    sock_path = socket_path(path)
+    if Client(path).request('ping') is not None:
+        raise AlreadyRunningError(sock_path)
+    try:
+        # left behind by a daemon that was killed
+        os.remove(sock_path)
+    except FileNotFoundError:
+        pass
+    state = State(path)
+
+    class Handler(socketserver.StreamRequestHandler):
+
+        def handle(self):
+            # one JSON request per line, answered by one JSON line: {"ok": true, "result": ...} or
+            # {"ok": false, "error": ...}
+            for line in self.rfile:
+                stop = False
+                try:
+                    request = json.loads(line)
+                    if request['op'] == 'stop':
+                        if _peer_uid(self.connection) not in (0, os.getuid()):
+                            raise PermissionError('only the owner of the daemon can stop it')
+                        stop = True
+                        result = None
+                    else:
+                        with state.lock:
+                            state.refresh()
+                            result = state.handle(request['op'], request.get('args', {}))
+                    response = {'ok': True, 'result': result}
+                except Exception as e:
+                    response = {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+                self.wfile.write(json.dumps(response).encode() + b'\n')
+                self.wfile.flush()
+                if stop:
+                    # only after the reply went out, the process exits as soon as serve_forever returns
+                    threading.Thread(target=server.shutdown).start()
+                    return
+
+    server = socketserver.ThreadingUnixStreamServer(sock_path, Handler)
+    server.daemon_threads = True
+    # only read-only queries are served, users without write access may use the daemon too
+    os.chmod(sock_path, 0o666)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        try:
+            os.remove(sock_path)
+        except FileNotFoundError:
+            pass
+
+
+def start(path: str, wait: float = 5):
+    import subprocess
+
+    if getattr(sys, 'frozen', False):
+        # in a PyInstaller build sys.executable is the mdt binary itself, it serves through its own
+        # 'daemon run' command (for the root it was built for)
+        args = [sys.executable, 'daemon', 'run']
+        cwd = os.path.dirname(sys.executable)
+    else:
+        # started as a module so the daemon does not depend on how mdt itself was launched
+        args = [sys.executable, '-m', 'mdt.daemon', path]
+        cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen(args, cwd=cwd,
+                               stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    deadline = time.monotonic() + wait
+    while time.monotonic() < deadline:
+        response = Client(path).request('ping')
+        if response is not None:
+            return response['result']['pid']
+        if process.poll() is not None:
+            return None
+        time.sleep(0.05)
+    return None
+
+
+class Client:
+
+    def __init__(self, path: str):
+        self._path = socket_path(path)
+        self._sock = None
+        self._file = None
+
+    def request(self, op: str, **args):
+        # returns the response, or None when no daemon answers so the caller can work on the files directly
+        try:
+            if self._sock is None:
+                self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self._sock.settimeout(TIMEOUT)
+                self._sock.connect(self._path)
+                self._file = self._sock.makefile('rwb')
+            self._file.write(json.dumps({'op': op, 'args': args}).encode() + b'\n')
+            self._file.flush()
+            response = json.loads(self._file.readline())
+        except (OSError, ValueError):
+            self.close()
+            return None
+        if not response.get('ok'):
+            return None
+        return response
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+        self._sock = None
+        self._file = None
+
+
+if __name__ == '__main__':
+    serve(sys.argv[1])
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+import errno
+import fcntl
+import json
+import os
+import shutil
+import stat
+
+from .fileio import locked, write_json_atomic
+
+# linux ioctl that clones a file's extents (btrfs, xfs with reflink=1, bcachefs)
+FICLONE = 0x40049409
+# smaller files are not worth a hash, a store entry and a link
+MIN_SIZE = 4096
+MODES = ('off', 'reflink', 'hardlink')
+
+
+class ReflinkUnsupported(Exception):
+    pass
+
+
+def reflink(src: str, dst: str):
+    try:
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    except OSError as e:
+        os.remove(dst)
+        if e.errno in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.EBADF):
+            raise ReflinkUnsupported(src)
+        raise
+
+
+def copy_function(mode: str):
+    # used as copytree copy_function for repository -> package-data copies
+    if mode == 'hardlink':
+        def link(src, dst):
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copy2(src, dst)
+        return link
+    if mode == 'reflink':
+        def clone(src, dst):
+            try:
+                reflink(src, dst)
+                shutil.copystat(src, dst)
+            except ReflinkUnsupported:
+                shutil.copy2(src, dst)
+        return clone
+    return shutil.copy2
+
+
+class Store:
+    # objects/<sha256> holds one copy of every deduplicated file, refs.json counts the installed trees
+    # using it and trees/<name>.json lists the objects of each tree so uninstall can drop its references
+
+    def __init__(self, path: str, mode: str = 'off'):
+        self._path = path
+        self._mode = mode if mode in MODES else 'off'
+
+    def dedup_tree(self, tree: str):
+        if self._mode == 'off':
+            return 0
+        objects = os.path.join(self._path, 'objects')
+        os.makedirs(os.path.join(self._path, 'trees'), exist_ok=True)
+        os.makedirs(objects, exist_ok=True)
+        saved = 0
+        used = []
+        with locked(os.path.join(self._path, '.lock')):
+            refs = self._read_refs()
+            try:
+                for root, _, files in os.walk(tree):
+                    for name in files:
+                        p = os.path.join(root, name)
+                        try:
+                            st = os.lstat(p)
+                            if not stat.S_ISREG(st.st_mode) or st.st_size < MIN_SIZE:
+                                continue
+                            digest = _hash_file(p)
+                            stored = os.path.join(objects, digest)
+                            if os.path.exists(stored) and self._mode == 'hardlink' and _hash_file(stored) != digest:
+                                # an installation changed its hardlinked copy in place; the other trees keep
+                                # that inode, new links go to a fresh object
+                                os.remove(stored)
+                            if os.path.exists(stored):
+                                if os.path.samefile(stored, p):
+                                    continue
+                                self._replace(stored, p)
+                                saved += st.st_size
+                            else:
+                                self._add(p, stored)
+                        except OSError:
+                            # e.g. EMLINK or a file the script left unreadable, it just stays a private copy
+                            continue
+                        refs[digest] = refs.get(digest, 0) + 1
+                        used.append(digest)
+            except ReflinkUnsupported:
+                # the filesystem cannot share extents, copies would only double disk usage
+                pass
+            write_json_atomic(os.path.join(self._path, 'refs.json'), refs)
+            write_json_atomic(os.path.join(self._path, 'trees', os.path.basename(tree) + '.json'), used)
+        return saved
+
+    def release_tree(self, tree: str):
+        record = os.path.join(self._path, 'trees', os.path.basename(tree) + '.json')
+        if not os.path.isfile(record):
+            return
+        with locked(os.path.join(self._path, '.lock')):
+            with open(record, 'r') as f:
+                used = json.load(f)
+            refs = self._read_refs()
+            for digest in used:
+                refs[digest] = refs.get(digest, 1) - 1
+                if refs[digest] <= 0:
+                    del refs[digest]
+                    try:
+                        os.remove(os.path.join(self._path, 'objects', digest))
+                    except FileNotFoundError:
+                        pass
+            write_json_atomic(os.path.join(self._path, 'refs.json'), refs)
+            os.remove(record)
+
+    def _add(self, p: str, stored: str):
+        if self._mode == 'hardlink':
+            # hardlinks are not copy-on-write: a program writing one of its files in place changes it for
+            # every installation sharing it. Permissions would not prevent that (root ignores them, and
+            # read-only files break tools that rewrite their data), so objects are re-hashed before reuse
+            # instead and the mode is only meant for data that stays unchanged, use reflink otherwise
+            os.link(p, stored)
+        else:
+            reflink(p, stored)
+
+    def _replace(self, stored: str, p: str):
+        tmp = p + '.mdt-dedup'
+        try:
+            if self._mode == 'hardlink':
+                os.link(stored, tmp)
+            else:
+                reflink(stored, tmp)
+                shutil.copystat(p, tmp)
+            os.replace(tmp, p)
+        except OSError:
+            try:
+                os.remove(tmp)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def _read_refs(self):
+        try:
+            with open(os.path.join(self._path, 'refs.json'), 'r') as f:
+                return json.load(f)
+        except Exception:
+            return {}
+
+
+def _hash_file(path: str):
+    import hashlib
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
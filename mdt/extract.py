@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import ZipFile
+
+BUFFER_SIZE = 1024 * 1024
+MAX_TOTAL_SIZE = 8 * 1024 * 1024 * 1024
+# members expanding more than this are treated as zip bombs
+MAX_RATIO = 200
+
+
+class UnsafeArchiveError(Exception):
+    pass
+
+
+def _check_members(infos: list, max_size: int):
+    total = 0
+    for info in infos:
+        name = info.filename
+        parts = name.replace('\\', '/').split('/')
+        if name.startswith('/') or '..' in parts or ':' in parts[0]:
+            raise UnsafeArchiveError(f'{name} points outside the extraction directory')
+        if stat.S_ISLNK(info.external_attr >> 16):
+            raise UnsafeArchiveError(f'{name} is a symlink')
+        if info.compress_size and info.file_size > BUFFER_SIZE and info.file_size / info.compress_size > MAX_RATIO:
+            raise UnsafeArchiveError(f'{name} has a suspicious compression ratio')
+        total += info.file_size
+    if total > max_size:
+        raise UnsafeArchiveError(f'archive expands to {total} bytes, the limit is {max_size}')
+
+
+def _extract_members(archive: str, dst: str, infos: list):
+    # every worker reads through its own handle, zlib releases the GIL while inflating
+    with ZipFile(archive, 'r') as zipf:
+        for info in infos:
+            target = os.path.join(dst, info.filename)
+            written = 0
+            with zipf.open(info) as src, open(target, 'wb') as out:
+                while True:
+                    chunk = src.read(BUFFER_SIZE)
+                    if not chunk:
+                        break
+                    written += len(chunk)
+                    # the sizes in the central directory could lie
+                    if written > info.file_size:
+                        raise UnsafeArchiveError(f'{info.filename} is larger than announced')
+                    out.write(chunk)
+
+
+def extract(archive: str, dst: str, workers: int = None, max_size: int = MAX_TOTAL_SIZE):
+    with ZipFile(archive, 'r') as zipf:
+        infos = zipf.infolist()
+    _check_members(infos, max_size)
+    os.makedirs(dst, exist_ok=True)
+    files = []
+    for info in infos:
+        if info.is_dir():
+            os.makedirs(os.path.join(dst, info.filename), exist_ok=True)
+        else:
+            os.makedirs(os.path.dirname(os.path.join(dst, info.filename)), exist_ok=True)
+            files.append(info)
+    workers = workers or os.cpu_count() or 1
+    # largest members first so no worker ends up with all the big files
+    files.sort(key=lambda i: i.file_size, reverse=True)
+    batches = [files[n::workers] for n in range(workers)]
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for future in [pool.submit(_extract_members, archive, dst, batch) for batch in batches if batch]:
+                future.result()
+    except BaseException:
+        shutil.rmtree(dst, ignore_errors=True)
+        raise
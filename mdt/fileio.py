@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import errno
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+_held_locks = threading.local()
+# renameat2() arguments, see linux/fcntl.h and linux/fs.h
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+
+@contextmanager
+def locked(path: str):
+    # flock excludes other processes and other threads (each opens its own descriptor);
+    # nested use of the same lock in one thread is a no-op instead of a deadlock
+    path = os.path.abspath(path)
+    held = getattr(_held_locks, 'paths', None)
+    if held is None:
+        held = _held_locks.paths = set()
+    if path in held:
+        yield
+        return
+    with open(path, 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        held.add(path)
+        try:
+            yield
+        finally:
+            held.discard(path)
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def write_json_atomic(path: str, data, indent: int = None):
+    import tempfile
+
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=indent)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def exchange(a: str, b: str):
+    # swaps two paths in one atomic step, raises OSError with ENOSYS or EINVAL where the kernel, libc or
+    # filesystem cannot do it
+    import ctypes
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    try:
+        renameat2 = libc.renameat2
+    except AttributeError:
+        raise OSError(errno.ENOSYS, 'renameat2 is not available', a)
+    if renameat2(AT_FDCWD, os.fsencode(a), AT_FDCWD, os.fsencode(b), RENAME_EXCHANGE) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error), a)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import fcntl
+import json
+import os
+
+from .fileio import write_json_atomic
+
+
+class JournalEntry:
+    # an operation in progress; its lock file stays locked while the owning process is alive,
+    # so a left-over entry whose lock can be taken belongs to a crashed or killed process
+
+    def __init__(self, path: str, entry_id: str, lock_file, data: dict):
+        self._path = path
+        self._lock_file = lock_file
+        self.id = entry_id
+        self.data = data
+
+    def update(self, **data):
+        self.data.update(data)
+        write_json_atomic(os.path.join(self._path, self.id + '.json'), self.data, indent=2)
+
+    def finish(self):
+        try:
+            os.remove(os.path.join(self._path, self.id + '.json'))
+        except FileNotFoundError:
+            pass
+        try:
+            os.remove(os.path.join(self._path, self.id + '.lock'))
+        except FileNotFoundError:
+            pass
+        self._lock_file.close()
+
+
+class Journal:
+
+    def __init__(self, path: str):
+        self._path = path
+
+    def begin(self, op: str, **data):
+        import uuid
+
+        os.makedirs(self._path, exist_ok=True)
+        entry_id = str(uuid.uuid4())
+        lock_file = open(os.path.join(self._path, entry_id + '.lock'), 'w')
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        entry = JournalEntry(self._path, entry_id, lock_file, {'id': entry_id, 'op': op, 'state': 'started'})
+        entry.update(**data)
+        return entry
+
+    def abandoned(self):
+        # entries of operations that can no longer finish by themselves, returned locked
+        ret = []
+        for entry_id, data in self._entries():
+            # the lock is taken before the entry is written, so a missing lock file also means a dead owner
+            lock_file = open(os.path.join(self._path, entry_id + '.lock'), 'a')
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                continue
+            ret.append(JournalEntry(self._path, entry_id, lock_file, data))
+        return ret
+
+    def active_paths(self):
+        # paths touched by operations that are still running in other processes
+        paths = set()
+        for _, data in self._entries():
+            paths.add(data.get('package-path'))
+            paths.add(data.get('program-path'))
+        return paths
+
+    def _entries(self):
+        if not os.path.isdir(self._path):
+            return
+        for name in sorted(os.listdir(self._path)):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self._path, name), 'r') as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            yield name[:-len('.json')], data
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import sys
+
+from .fileio import write_json_atomic
+
+
+class LaunchError(Exception):
+    pass
+
+
+class LaunchCache:
+    # launch-cache.json keeps the resolved start command of every program launched so far; it is stamped
+    # with the package-data mtime, which changes with every install and uninstall
+
+    def __init__(self, path: str):
+        self._path = os.path.join(path, 'launch-cache.json')
+        self._data_path = os.path.join(path, 'package-data')
+
+    def stamp(self):
+        return os.stat(self._data_path).st_mtime_ns
+
+    def get(self, name: str, version: str):
+        try:
+            with open(self._path, 'r') as f:
+                cache = json.load(f)
+            if cache['mtime'] != self.stamp():
+                return None
+            return cache['plans'].get(name, {}).get(version)
+        except Exception:
+            return None
+
+    def put(self, name: str, version: str, plan: dict, stamp: int):
+        # stamp is taken before the plan was resolved, so a plan racing an uninstall is never trusted
+        try:
+            with open(self._path, 'r') as f:
+                cache = json.load(f)
+            if cache['mtime'] != stamp:
+                raise ValueError
+        except Exception:
+            cache = {'mtime': stamp, 'plans': {}}
+        cache['plans'].setdefault(name, {})[version] = plan
+        try:
+            write_json_atomic(self._path, cache)
+        except OSError:
+            # users without write access just resolve the plan every time
+            pass
+
+
+def resolve(packs, name: str, version: str = None):
+    if len(packs.get_installations_of(name)) == 0:
+        raise LaunchError(f'Program \'{name}\' could not be found.')
+    try:
+        version = version or packs.get_config_of(name)['version']
+    except (TypeError, KeyError):
+        raise LaunchError('No default version. please specify.')
+    path_to_manifest = packs.is_installed(name, version)
+    if path_to_manifest is None:
+        raise LaunchError(f'{name} has no version {version}.')
+    return plan_of(path_to_manifest)
+
+
+def plan_of(manifest_path: str):
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    script = os.path.join(os.path.split(manifest_path)[0], manifest['start-script'])
+    return {'script': script, 'program-dir': manifest['program-dir'], 'version': manifest['version']}
+
+
+def launch(plan: dict, mode: str = 'subprocess'):
+    argv = [plan['script'], plan['program-dir'], plan['version']]
+    if mode == 'inprocess':
+        import runpy
+        # the start script runs as __main__ in this interpreter, exactly as python3 would run it
+        sys.argv = argv
+        sys.path.insert(0, os.path.dirname(plan['script']))
+        runpy.run_path(plan['script'], run_name='__main__')
+    elif mode == 'subprocess':
+        import subprocess
+        subprocess.call(['python3'] + argv)
+    else:
+        # the program replaces mdt instead of running under a second, idle interpreter
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.execvp('python3', ['python3'] + argv)
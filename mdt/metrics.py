@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import time
+
+from .fileio import locked, write_json_atomic
+
+# upper bounds in seconds of the duration histogram buckets
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+PREFIX = 'mdt_'
+
+
+def _key(name: str, labels: dict):
+    # series are stored under their Prometheus name, e.g. operations_total{operation="install",outcome="success"}
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{k}="{labels[k]}"' for k in sorted(labels)) + '}'
+
+
+class Metrics:
+    # counters and histograms accumulated across runs in <root>/metrics.json, every change is a locked
+    # read-modify-write so concurrent mdt processes never lose each other's updates
+
+    def __init__(self, path: str):
+        self._path = os.path.join(path, 'metrics.json')
+        self._lock = os.path.join(path, '.metrics.lock')
+
+    def read(self):
+        try:
+            with open(self._path, 'r') as f:
+                return json.load(f)
+        except Exception:
+            return {'counters': {}, 'histograms': {}}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self._update(counters={_key(name, labels): value})
+
+    def observe(self, name: str, value: float, **labels):
+        self._update(observations={_key(name, labels): value})
+
+    def operation(self, operation: str, started: float, error: BaseException = None):
+        # duration and outcome of an install, uninstall or update; started is a time.monotonic() value
+        outcome = 'success' if error is None else 'failure'
+        counters = {_key('operations_total', {'operation': operation, 'outcome': outcome}): 1}
+        if error is not None:
+            counters[_key('failures_total', {'operation': operation, 'type': type(error).__name__})] = 1
+        self._update(counters=counters,
+                     observations={_key('operation_duration_seconds', {'operation': operation, 'outcome': outcome}): time.monotonic() - started})
+
+    def _update(self, counters: dict = None, observations: dict = None):
+        try:
+            with locked(self._lock):
+                data = self.read()
+                for key, value in (counters or {}).items():
+                    data['counters'][key] = data['counters'].get(key, 0) + value
+                for key, value in (observations or {}).items():
+                    histogram = data['histograms'].setdefault(key, {'buckets': [0] * len(BUCKETS), 'sum': 0, 'count': 0})
+                    for i, bound in enumerate(BUCKETS):
+                        if value <= bound:
+                            histogram['buckets'][i] += 1
+                    histogram['sum'] += value
+                    histogram['count'] += 1
+                write_json_atomic(self._path, data)
+        except OSError:
+            # users without write access run unrecorded, metrics never fail an operation
+            pass
+
+
+def prometheus(data: dict, gauges: dict = None):
+    # Prometheus text exposition format as read by the node_exporter textfile collector
+    lines = []
+    typed = set()
+
+    def declare(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f'# TYPE {PREFIX}{name} {kind}')
+
+    for key, value in sorted((gauges or {}).items()):
+        declare(key.split('{')[0], 'gauge')
+        lines.append(f'{PREFIX}{key} {value}')
+    for key, value in sorted(data['counters'].items()):
+        declare(key.split('{')[0], 'counter')
+        lines.append(f'{PREFIX}{key} {value}')
+    for key, histogram in sorted(data['histograms'].items()):
+        name, _, labels = key.partition('{')
+        labels = labels.rstrip('}')
+        declare(name, 'histogram')
+        separator = ',' if labels else ''
+        for bound, count in zip(BUCKETS, histogram['buckets']):
+            lines.append(f'{PREFIX}{name}_bucket{{{labels}{separator}le="{bound}"}} {count}')
+        lines.append(f'{PREFIX}{name}_bucket{{{labels}{separator}le="+Inf"}} {histogram["count"]}')
+        suffix = '{' + labels + '}' if labels else ''
+        lines.append(f'{PREFIX}{name}_sum{suffix} {histogram["sum"]}')
+        lines.append(f'{PREFIX}{name}_count{suffix} {histogram["count"]}')
+    return '\n'.join(lines) + '\n'
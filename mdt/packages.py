@@ -2,12 +2,16 @@
 
 import os
 import json
-import shutil
 import sys
-import uuid
-import subprocess
+import time
 
-from .repository import Repository, MissingFileError, InvalidManifestError
+from .fileio import locked, write_json_atomic
+from .journal import Journal
+from .metrics import Metrics
+from .repository import Repository, MissingFileError, InvalidManifestError, search_index_path
+from .search import load_index
+from .tracing import span, traced
+from .versions import matches, newest, parse_requirement
 
 
 class NoInstallCandidate(Exception):
@@ -18,6 +22,10 @@ class ErrorInInstallScript(Exception):
     pass
 
 
+class ScriptTimeoutError(ErrorInInstallScript):
+    pass
+
+
 class AlreadyInstalledError(Exception):
     pass
 
@@ -34,124 +42,177 @@ class PackageNotInstalled(Exception):
     pass
 
 
+class DependencyCycleError(Exception):
+    pass
+
+
+class DependencyConflictError(Exception):
+    pass
+
+
+class DependencyFailedError(Exception):
+    pass
+
+
+_config_cache = {}
+
+
+def script_log(path: str, package_name: str):
+    # install and remove script output of a package, kept across installs and rotated by mdt.runner
+    return os.path.join(path, 'installed-programs', 'logs', package_name + '.log')
+
+
+def _script_error(cls, message: str, tail: list, log: str):
+    # the first line names the log, summaries such as install_many's only show that line
+    return cls('\n'.join([f'{message}, full output in {log}'] + ['    ' + line for line in tail]))
+
+
+def script_environment(path: str):
+    # install and remove scripts find the shared artifact cache (see mdt.cache) through MDT_CACHE_DIR
+    return dict(os.environ, MDT_CACHE_DIR=os.path.join(path, 'cache'))
+
+
 class VersionConfig:
 
+    @staticmethod
+    def lock(path: str):
+        # guards version-config.json and package-index.json across processes and install threads
+        return locked(os.path.join(path, '.lock'))
+
     @staticmethod
     def get_config(path: str):
+        # version-config.json maps package names to their default version; the parsed file is cached
+        # per process and re-read only when the file on disk is replaced
+        config_path = os.path.join(path, 'package-data', 'version-config.json')
         try:
-            with open(os.path.join(path, 'package-data', 'version-config.json'), 'r') as f:
-                config = json.load(f)
+            st = os.stat(config_path)
+            stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+            cached = _config_cache.get(config_path)
+            if cached is not None and cached[0] == stamp:
+                return cached[1]
+            with open(config_path, 'r') as f:
+                config = VersionConfig._migrate(json.load(f))
+            _config_cache[config_path] = (stamp, config)
             return config
         except Exception:
             return None
 
     @staticmethod
+    @traced('version-config.edit')
     def edit(path: str, d: dict):
-        try:
-            added = False
-            new_config = []
-            with open(os.path.join(path, 'package-data', 'version-config.json'), 'r') as f:
-                config = json.load(f)
-            for c in config:
-                if c['name'] == d['name']:
-                    new_config.append(d)
-                    added = True
-                else:
-                    new_config.append(c)
-            if added is False:
-                new_config.append(d)
-            with open(os.path.join(path, 'package-data', 'version-config.json'), 'w') as f:
-                json.dump(new_config, f, indent=2)
-        except Exception as e:
-            raise e
+        with VersionConfig.lock(path):
+            config = dict(VersionConfig.get_config(path))
+            config[d['name']] = d['version']
+            write_json_atomic(os.path.join(path, 'package-data', 'version-config.json'), config, indent=2)
 
     @staticmethod
+    @traced('version-config.remove')
     def remove(path: str, package_name: str):
-        try:
-            new_config = []
-            with open(os.path.join(path, 'package-data', 'version-config.json'), 'r') as f:
-                config = json.load(f)
-            for c in config:
-                if c['name'] != package_name:
-                    new_config.append(c)
-            with open(os.path.join(path, 'package-data', 'version-config.json'), 'w') as f:
-                json.dump(new_config, f, indent=2)
-        except Exception as e:
-            raise e
+        with VersionConfig.lock(path):
+            config = dict(VersionConfig.get_config(path))
+            config.pop(package_name, None)
+            write_json_atomic(os.path.join(path, 'package-data', 'version-config.json'), config, indent=2)
+
+    @staticmethod
+    def _migrate(config):
+        # older releases stored a list of {"name": ..., "version": ...} entries, it is rewritten on the next edit
+        if type(config) is list:
+            return {c['name']: c['version'] for c in config}
+        return config
 
 
 class Packages:
 
+    @traced('packages.load')
     def __init__(self, package_path: str = None):
         self._package_path = package_path or os.path.join('/opt', 'mdt', 'installed-programs')
+        self._index_path = os.path.join(self._package_path, 'package-index.json')
         self._pack_list = self._load_repo()
+        self._build_lookups()
 
     def is_installed(self, package_name: str, package_version: str):
-        for pack in os.listdir(os.path.join(self._package_path, 'package-data')):
-            p = os.path.join(self._package_path, 'package-data', pack, 'manifest.json')
-            if os.path.isfile(p):
-                try:
-                    with open(p, 'r') as f:
-                        pm = json.load(f)
-                    if pm['name'] == package_name and pm['version'] == package_version:
-                        return p
-                except Exception:
-                    continue
+        entry = self._by_version.get((package_name, package_version))
+        if entry is not None:
+            return entry['path']
 
     def get_installations_of(self, package_name: str):
-        ret_li = []
-        for pack in os.listdir(os.path.join(self._package_path, 'package-data')):
-            p = os.path.join(self._package_path, 'package-data', pack, 'manifest.json')
-            if os.path.isfile(p):
-                try:
-                    with open(p, 'r') as f:
-                        pm = json.load(f)
-                    if pm['name'] == package_name:
-                        ret_li.append({'name': pm['name'], 'version': pm['version'], 'path': p})
-                except Exception:
-                    continue
-        return ret_li
+        return [e.copy() for e in self._by_name.get(package_name, [])]
 
     def get_config_of(self, package_name: str):
         full_config = VersionConfig.get_config(self._package_path)
-        for c in full_config:
-            if c['name'] == package_name:
-                return c
+        if package_name in full_config:
+            return {'name': package_name, 'version': full_config[package_name]}
 
     def configure(self, package_name: str, version: str):
-        for pack in self.get_all_installed():
-            if pack['name'] == package_name and pack['version'] == version:
-                VersionConfig.edit(self._package_path, {'name': package_name, 'version': version})
-                return
+        if (package_name, version) in self._by_version:
+            VersionConfig.edit(self._package_path, {'name': package_name, 'version': version})
 
     def get_all_installed(self):
-        ret_li = []
-        for pack in os.listdir(os.path.join(self._package_path, 'package-data')):
-            p = os.path.join(self._package_path, 'package-data', pack, 'manifest.json')
+        return [e.copy() for e in self._pack_list.values()]
+
+    @traced('packages.register')
+    def register(self, package_dir: str):
+        p = os.path.join(package_dir, 'manifest.json')
+        with open(p, 'r') as f:
+            pm = json.load(f)
+        with VersionConfig.lock(self._package_path):
+            # reload first so entries registered by other installers since __init__ are kept
+            self._pack_list = self._load_repo()
+            self._pack_list[os.path.basename(package_dir)] = {'name': pm['name'], 'version': pm['version'], 'path': p}
+            self._build_lookups()
+            self._write_index()
+
+    @traced('packages.unregister')
+    def unregister(self, package_dir: str):
+        with VersionConfig.lock(self._package_path):
+            self._pack_list = self._load_repo()
+            self._pack_list.pop(os.path.basename(package_dir), None)
+            self._build_lookups()
+            self._write_index()
+
+    def _build_lookups(self):
+        self._by_name = {}
+        self._by_version = {}
+        for entry in self._pack_list.values():
+            self._by_name.setdefault(entry['name'], []).append(entry)
+            self._by_version[(entry['name'], entry['version'])] = entry
+
+    def _load_repo(self):
+        data_path = os.path.join(self._package_path, 'package-data')
+        # taken before listing, so a directory added during the scan makes the next load look again
+        self._stamp = os.stat(data_path).st_mtime_ns
+        try:
+            with open(self._index_path, 'r') as f:
+                index = json.load(f)
+            if index['mtime'] == self._stamp:
+                return index['packages']
+            packs = index['packages']
+        except Exception:
+            packs = {}
+        # package-data changed behind our back, only parse manifests of directories the index does not know yet
+        repo = {}
+        for d in os.listdir(data_path):
+            if d in packs:
+                repo[d] = packs[d]
+                continue
+            p = os.path.join(data_path, d, 'manifest.json')
             if os.path.isfile(p):
                 try:
                     with open(p, 'r') as f:
                         pm = json.load(f)
-                        ret_li.append({'name': pm['name'], 'version': pm['version'], 'path': p})
+                    repo[d] = {'name': pm['name'], 'version': pm['version'], 'path': p}
                 except Exception:
                     continue
-        return ret_li
-
-    def _load_repo(self):
-        dirs = []
-        repo = []
-        for d in os.listdir(os.path.join(self._package_path, 'package-data')):
-            if os.path.isdir(os.path.join(self._package_path, 'package-data', d)):
-                dirs.append(os.path.join(self._package_path, 'package-data', d))
-        for di in dirs:
-            with open(os.path.join(di, 'manifest.json'), 'r') as f:
-                j = json.load(f)
-            j['install-script'] = os.path.join(di, j['install-script'])
-            j['remove-script'] = os.path.join(di, j['remove-script'])
-            j['start-script'] = os.path.join(di, j['start-script'])
-            repo.append(j)
+        self._pack_list = repo
+        self._write_index()
         return repo
 
+    def _write_index(self):
+        try:
+            write_json_atomic(self._index_path, {'mtime': self._stamp, 'packages': self._pack_list})
+        except OSError:
+            pass
+
     @staticmethod
     def verify_installed_entry(d: str):
         try:
@@ -188,13 +249,30 @@ class Packages:
             raise MissingFileError('icon file is missing')
 
 
-def install(package_name: str, version: str = None, path: str = None, verbose: bool = False):
+@traced('install')
+def install(package_name: str, version: str = None, path: str = None, verbose: bool = False, dedup: str = 'off',
+            package_mode: str = 'copy', script_timeout: float = None):
 
+    # modules only install, uninstall and fsck need stay out of the startup of read-only commands
+    import shutil
+    import uuid
+
+    from . import dedup as deduplication
+    from .runner import ScriptTimeout, run_script
+    from .snapshots import SnapshotStore
+
+    started = time.monotonic()
     # Install globals
     r = Repository(os.path.join(path, 'repository'))
     p = Packages(os.path.join(path, 'installed-programs'))
     package_path = os.path.join(path, 'installed-programs', 'package-data', str(uuid.uuid4()))
     dst_path = os.path.join(path, 'installed-programs', 'program-data', str(uuid.uuid4()))
+    snapshots = SnapshotStore(os.path.join(path, 'installed-programs', 'snapshots'))
+    snapshot_hash = None
+    entry = None
+    if version is not None:
+        # version specs such as 'latest' or '>=1.2,<2' resolve to the newest matching version
+        version = r.resolve(package_name, version) or version
     repo_package = r.get(package_name, version)
 
     def verify():
@@ -206,16 +284,30 @@ def install(package_name: str, version: str = None, path: str = None, verbose: b
         return install_v
 
     def setup():
+        nonlocal snapshot_hash
         os.mkdir(dst_path)
-        shutil.copytree(scr_path, package_path)
-        with open(os.path.join(package_path, 'manifest.json'), 'r') as f:
-            package_manifest = json.load(f)
+        if package_mode == 'snapshot':
+            # only the manifest is written per installation, everything else links into a pinned
+            # snapshot of the repository package that repository updates never touch
+            snapshot, snapshot_hash = snapshots.pin(scr_path, r.content_hash(repo_package['name']), os.path.basename(package_path),
+                                                    deduplication.copy_function(dedup))
+            os.mkdir(package_path)
+            for entry in os.listdir(snapshot):
+                if entry != 'manifest.json':
+                    os.symlink(os.path.join(snapshot, entry), os.path.join(package_path, entry))
+            with open(os.path.join(snapshot, 'manifest.json'), 'r') as f:
+                package_manifest = json.load(f)
+            package_manifest['snapshot'] = snapshot_hash
+        else:
+            shutil.copytree(scr_path, package_path, copy_function=deduplication.copy_function(dedup))
+            with open(os.path.join(package_path, 'manifest.json'), 'r') as f:
+                package_manifest = json.load(f)
         package_manifest['program-dir'] = dst_path
         package_manifest['version'] = install_version
         del package_manifest['versions']
         del package_manifest['default-version']
-        with open(os.path.join(package_path, 'manifest.json'), 'w') as f:
-            json.dump(package_manifest, f, indent=2)
+        # replaced rather than rewritten in place, the copied manifest may be a hardlink into the repository
+        write_json_atomic(os.path.join(package_path, 'manifest.json'), package_manifest, indent=2)
         return package_manifest, os.path.join(package_path, package_manifest['install-script'])
 
     def cleanup_broken():
@@ -227,51 +319,81 @@ def install(package_name: str, version: str = None, path: str = None, verbose: b
             shutil.rmtree(package_path)
         except Exception:
             pass
+        if snapshot_hash is not None:
+            snapshots.release(snapshot_hash, os.path.basename(package_path))
+        if entry is not None:
+            entry.finish()
 
     def edit_version_config():
         config = VersionConfig.get_config(os.path.join(path, 'installed-programs'))
-        for c in config:
-            if c['name'] == repo_package['name']:
-                return
+        if repo_package['name'] in config:
+            return
         VersionConfig.edit(os.path.join(path, 'installed-programs'), {'name': repo_package['name'], 'version': install_version})
 
     try:
         # verify & get version
         install_version = verify()
         scr_path = os.path.split(repo_package['install-script'])[0]
+        # journaled so an install killed half way is rolled back or finished by recover()
+        entry = Journal(os.path.join(path, 'installed-programs', 'journal')).begin(
+            'install', name=repo_package['name'], version=install_version,
+            **{'package-path': package_path, 'program-path': dst_path})
         # setup & get manifest/install script
-        manifest, install_script = setup()
+        with span('install.setup', package=package_name, mode=package_mode):
+            manifest, install_script = setup()
 
         # run install script
         try:
-            subprocess.call(['python3', install_script, manifest['program-dir'], manifest['version']], stderr=subprocess.PIPE)
+            with span('install.script', package=package_name):
+                returncode, tail = run_script(['python3', install_script, manifest['program-dir'], manifest['version']],
+                                              script_log(path, package_name), script_timeout, script_environment(path), verbose)
+        except ScriptTimeout as e:
+            raise _script_error(ScriptTimeoutError, f'install script timed out after {script_timeout} s', e.tail, script_log(path, package_name))
         except Exception:
             raise ErrorInInstallScript
+        if returncode != 0:
+            raise _script_error(ErrorInInstallScript, f'install script exited with code {returncode}', tail, script_log(path, package_name))
+        try:
+            with span('install.dedup', package=package_name, mode=dedup):
+                deduplication.Store(os.path.join(path, 'installed-programs', '.store'), dedup).dedup_tree(dst_path)
+        except Exception:
+            # deduplication only saves space, the installation itself is complete
+            pass
+        entry.update(state='script-done')
         # configure version
-        edit_version_config()
+        with VersionConfig.lock(os.path.join(path, 'installed-programs')):
+            edit_version_config()
+            p.register(package_path)
+        entry.finish()
+        Metrics(path).operation('install', started)
     except AlreadyInstalledError as e:
+        Metrics(path).operation('install', started, e)
         if verbose:
             print('ERR: package already installed')
             return
         else:
             raise e
     except NoInstallCandidate as e:
+        Metrics(path).operation('install', started, e)
         if verbose:
             print('ERR: package has on installation candidate')
             return
         else:
             raise e
     except ErrorInInstallScript as e:
+        Metrics(path).operation('install', started, e)
         cleanup_broken()
         if verbose:
-            print('ERR: error in install script\nInstall failed!')
+            print(f'ERR: error in install script\n{e}\nInstall failed!' if str(e) else 'ERR: error in install script\nInstall failed!')
             return
         else:
             raise e
-    except KeyboardInterrupt:
+    except KeyboardInterrupt as e:
+        Metrics(path).operation('install', started, e)
         cleanup_broken()
         sys.exit(0)
     except Exception as e:
+        Metrics(path).operation('install', started, e)
         cleanup_broken()
         if verbose:
             print('ERR: unknown error occurred during install\nInstall failed!')
@@ -280,10 +402,160 @@ def install(package_name: str, version: str = None, path: str = None, verbose: b
             raise e
 
 
-def uninstall(package_name: str, version: str = None, path: str = None, verbose: bool = False):
+@traced('resolve-dependencies')
+def resolve_dependencies(package_names: list, version: str = None, path: str = None):
+    # returns {name: {'version': ..., 'requires': [...]}} for every package that has to be installed,
+    # dependencies already satisfied by an installed version are left out
+    r = Repository(os.path.join(path, 'repository'))
+    p = Packages(os.path.join(path, 'installed-programs'))
+    constraints = {}
+    requires = {}
+    pending = list(package_names)
+    for name in package_names:
+        constraints[name] = [version] if version else []
+    while pending:
+        name = pending.pop()
+        if name in requires:
+            continue
+        entry = r.get(name)
+        if entry is None:
+            raise NoInstallCandidate(f'{name} has no installation candidate')
+        requires[name] = []
+        for requirement in entry.get('dependencies', []):
+            dep_name, spec = parse_requirement(requirement)
+            requires[name].append(dep_name)
+            constraints.setdefault(dep_name, [])
+            if spec:
+                constraints[dep_name].append(spec)
+            pending.append(dep_name)
+
+    state = {}
+
+    def visit(name, trail):
+        if state.get(name) == 'done':
+            return
+        if state.get(name) == 'visiting':
+            raise DependencyCycleError(' -> '.join(trail[trail.index(name):] + [name]))
+        state[name] = 'visiting'
+        for dep in requires[name]:
+            visit(dep, trail + [name])
+        state[name] = 'done'
+
+    for name in package_names:
+        visit(name, [])
+
+    plan = {}
+    for name, specs in constraints.items():
+        spec = ','.join(specs) or None
+        if name not in package_names:
+            installed = [i['version'] for i in p.get_installations_of(name)]
+            if any(matches(v, spec) for v in installed):
+                continue
+        if spec is None:
+            install_version = r.resolve(name)
+        elif len(specs) == 1 and name in package_names:
+            install_version = r.resolve(name, spec)
+        else:
+            install_version = newest(r.get(name)['versions'], spec)
+        if install_version is None:
+            raise DependencyConflictError(f'no version of {name} satisfies {spec}')
+        plan[name] = {'version': install_version, 'requires': requires[name]}
+    for entry in plan.values():
+        entry['requires'] = [dep for dep in entry['requires'] if dep in plan]
+    return plan
+
+
+@traced('install-many')
+def install_many(package_names: list, version: str = None, path: str = None, verbose: bool = False, workers: int = None,
+                 dedup: str = 'off', package_mode: str = 'copy', script_timeout: float = None):
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    started = time.monotonic()
+    unresolved = {}
+    try:
+        plan = resolve_dependencies(package_names, version, path)
+    except (NoInstallCandidate, DependencyCycleError, DependencyConflictError) as e:
+        if len(package_names) == 1:
+            Metrics(path).operation('install', started, e)
+            if verbose:
+                print(f'ERR: {e}\nInstall failed!')
+                return {package_names[0]: e}
+            raise e
+        # one bad name must not block the rest: every requested package is resolved on its own and
+        # the subtrees that resolve, and agree on shared dependencies, are installed
+        plan = {}
+        for root in package_names:
+            try:
+                subtree = resolve_dependencies([root], version, path)
+                for name, entry in subtree.items():
+                    if name in plan and plan[name]['version'] != entry['version']:
+                        raise DependencyConflictError(f'{root} needs {name} {entry["version"]}, '
+                                                      f'another package needs {plan[name]["version"]}')
+            except (NoInstallCandidate, DependencyCycleError, DependencyConflictError) as e:
+                Metrics(path).operation('install', started, e)
+                unresolved[root] = e
+                continue
+            plan.update(subtree)
+    if len(plan) == 1 and len(package_names) == 1:
+        install(package_names[0], plan[package_names[0]]['version'], path, verbose, dedup, package_mode, script_timeout)
+        return {package_names[0]: None}
+
+    # every package starts as soon as the packages it requires are installed,
+    # so independent branches of the dependency graph install concurrently
+    results = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while len(results) < len(plan):
+            for name, entry in plan.items():
+                if name in results or name in running.values():
+                    continue
+                # a requested package that is already installed still satisfies the packages requiring it
+                failed = [dep for dep in entry['requires']
+                          if dep in results and results[dep] is not None and not isinstance(results[dep], AlreadyInstalledError)]
+                if failed:
+                    results[name] = DependencyFailedError(f'{name} requires {", ".join(failed)}')
+                    Metrics(path).operation('install', started, results[name])
+                elif all(dep in results for dep in entry['requires']):
+                    running[pool.submit(install, name, entry['version'], path, False, dedup, package_mode, script_timeout)] = name
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    future.result()
+                    results[name] = None
+                except Exception as e:
+                    results[name] = e
+    results = {**unresolved, **results}
+    if verbose:
+        for name, error in results.items():
+            label = f'{name} {plan[name]["version"]}' if name in plan else name
+            if error is None:
+                print(f'    {label}: installed')
+            elif isinstance(error, AlreadyInstalledError):
+                print(f'    {label}: already installed')
+            else:
+                # script errors carry the output tail on further lines, the summary keeps to the first
+                message = str(error).splitlines()[0] if str(error) else ''
+                print(f'    {label}: failed ({type(error).__name__}{": " + message if message else ""})')
+        print(f'{sum(e is None for e in results.values())} of {len(results)} package(s) installed.')
+    return results
+
+
+@traced('uninstall')
+def uninstall(package_name: str, version: str = None, path: str = None, verbose: bool = False, script_timeout: float = None):
 
+    import shutil
+
+    from . import dedup as deduplication
+    from .runner import ScriptTimeout, run_script
+    from .snapshots import SnapshotStore
+
+    started = time.monotonic()
     # Install globals
     p = Packages(os.path.join(path, 'installed-programs'))
+    entry = None
 
     def verify(pack_version):
         packages = p.get_installations_of(package_name)
@@ -320,27 +592,13 @@ def uninstall(package_name: str, version: str = None, path: str = None, verbose:
                     print(ex)
                 raise FailedToUninstallError
 
-    def configure_version():
-        new_version = None
-        con = p.get_config_of(package_name)
-        if con['version'] != version:
-            return
-        versions = p.get_installations_of(package_name)
-        for v in versions:
-            if v['version'] != version:
-                new_version = v
-                break
-        if new_version is None:
-            VersionConfig.remove(os.path.join(path, 'installed-programs'), package_name)
-        else:
-            p.configure(package_name, new_version['version'])
-
     try:
         # verify package
         try:
             uninstall_pack, version = verify(version)
         except PackageNotInstalled as e:
             if verbose:
+                Metrics(path).operation('uninstall', started, e)
                 print('ERR: package could not be found\nUninstall failed!')
                 return
             else:
@@ -351,20 +609,52 @@ def uninstall(package_name: str, version: str = None, path: str = None, verbose:
         package_path = os.path.split(uninstall_pack['path'])[0]
         program_date_path = manifest['program-dir']
         uninstall_script = os.path.join(package_path, manifest['remove-script'])
+        # the uninstall can only go forward once cleanup started (state 'cleanup'), recover() completes it
+        # after a crash; before that nothing was removed and the entry is simply dropped
+        entry = Journal(os.path.join(path, 'installed-programs', 'journal')).begin(
+            'uninstall', name=package_name, version=version, snapshot=manifest.get('snapshot'),
+            **{'package-path': package_path, 'program-path': program_date_path})
+        # a failing remove script aborts the uninstall, like a failing install script aborts the install
         try:
-            subprocess.call(['python3', uninstall_script, program_date_path, version], stderr=subprocess.PIPE)
-        except Exception as e:
-            if verbose:
-                print('ERR: error running uninstall script')
-            else:
-                raise e
-        cleanup()
-        configure_version()
+            with span('uninstall.script', package=package_name):
+                returncode, tail = run_script(['python3', uninstall_script, program_date_path, version],
+                                              script_log(path, package_name), script_timeout, script_environment(path), verbose)
+        except ScriptTimeout as e:
+            raise _script_error(ScriptTimeoutError, f'remove script timed out after {script_timeout} s', e.tail, script_log(path, package_name))
+        except Exception:
+            raise ErrorInInstallScript
+        if returncode != 0:
+            raise _script_error(ErrorInInstallScript, f'remove script exited with code {returncode}', tail, script_log(path, package_name))
+        entry.update(state='cleanup')
+        with span('uninstall.cleanup', package=package_name):
+            cleanup()
+        if manifest.get('snapshot'):
+            SnapshotStore(os.path.join(path, 'installed-programs', 'snapshots')).release(manifest['snapshot'], os.path.basename(package_path))
+        deduplication.Store(os.path.join(path, 'installed-programs', '.store')).release_tree(program_date_path)
+        with VersionConfig.lock(os.path.join(path, 'installed-programs')):
+            p.unregister(package_path)
+            _configure_version(p, package_name, version)
+        entry.finish()
+        Metrics(path).operation('uninstall', started)
         print('Uninstalled successfully!')
-    except KeyboardInterrupt:
+    except KeyboardInterrupt as e:
+        Metrics(path).operation('uninstall', started, e)
+        if entry is not None:
+            entry.update(state='cleanup')
         cleanup()
         sys.exit(0)
+    except ErrorInInstallScript as e:
+        Metrics(path).operation('uninstall', started, e)
+        entry.finish()
+        if verbose:
+            print(f'ERR: error in remove script\n{e}\nUninstall failed!' if str(e) else 'ERR: error in remove script\nUninstall failed!')
+            return
+        else:
+            raise e
     except Exception as e:
+        Metrics(path).operation('uninstall', started, e)
+        if entry is not None and entry.data['state'] == 'started':
+            entry.finish()
         if verbose:
             print('ERR: error in uninstall\nUninstall failed!')
             return
@@ -372,11 +662,146 @@ def uninstall(package_name: str, version: str = None, path: str = None, verbose:
             raise e
 
 
-def search(search_string: str, path: str = None):
-    p = Repository(os.path.join(path, 'repository'))
-    packs = p.get()
-    ret = []
-    for pack in packs:
-        if search_string in pack['name']:
-            ret.append(pack)
-    return ret
+def _configure_version(p: Packages, package_name: str, version: str):
+    # moves the default away from a removed version, or drops it with the last installation
+    con = p.get_config_of(package_name)
+    if con is None or con['version'] != version:
+        return
+    new_version = None
+    versions = p.get_installations_of(package_name)
+    for v in versions:
+        if v['version'] != version:
+            new_version = v
+            break
+    if new_version is None:
+        VersionConfig.remove(p._package_path, package_name)
+    else:
+        p.configure(package_name, new_version['version'])
+
+
+def _discard(path: str, package_path: str, program_path: str = None, snapshot: str = None):
+    # removes an installation and everything it holds in the shared stores, parts may already be gone
+    import shutil
+
+    from . import dedup as deduplication
+    from .snapshots import SnapshotStore
+
+    if snapshot is None:
+        try:
+            with open(os.path.join(package_path, 'manifest.json'), 'r') as f:
+                snapshot = json.load(f).get('snapshot')
+        except Exception:
+            pass
+    shutil.rmtree(package_path, ignore_errors=True)
+    if snapshot:
+        SnapshotStore(os.path.join(path, 'installed-programs', 'snapshots')).release(snapshot, os.path.basename(package_path))
+    if program_path is not None:
+        shutil.rmtree(program_path, ignore_errors=True)
+        deduplication.Store(os.path.join(path, 'installed-programs', '.store')).release_tree(program_path)
+
+
+def recover(path: str):
+    # completes or undoes installs and uninstalls whose process died, see mdt.journal
+    installed = os.path.join(path, 'installed-programs')
+    recovered = []
+    for entry in Journal(os.path.join(installed, 'journal')).abandoned():
+        data = entry.data
+        if data['op'] == 'install' and data['state'] == 'script-done':
+            # the install script finished, only the bookkeeping is missing
+            with VersionConfig.lock(installed):
+                if data['name'] not in VersionConfig.get_config(installed):
+                    VersionConfig.edit(installed, {'name': data['name'], 'version': data['version']})
+                Packages(installed).register(data['package-path'])
+        elif data['op'] == 'uninstall' and data['state'] == 'started':
+            # died before cleanup, the installation is still complete
+            pass
+        else:
+            _discard(path, data['package-path'], data['program-path'], data.get('snapshot'))
+            with VersionConfig.lock(installed):
+                p = Packages(installed)
+                p.unregister(data['package-path'])
+                _configure_version(p, data['name'], data['version'])
+        entry.finish()
+        recovered.append(data)
+    return recovered
+
+
+def fsck(path: str):
+    import shutil
+
+    from . import dedup as deduplication
+    from .snapshots import SnapshotStore
+
+    installed = os.path.join(path, 'installed-programs')
+    data_path = os.path.join(installed, 'package-data')
+    program_path = os.path.join(installed, 'program-data')
+    report = {'recovered': len(recover(path)), 'broken-packages': 0, 'orphaned-programs': 0, 'stale-defaults': 0,
+              'stale-snapshots': 0}
+    journal = Journal(os.path.join(installed, 'journal'))
+
+    def in_use(p):
+        # paths of operations still running in other processes are left alone; the journal is read again
+        # right before every removal because an install may have started since the directories were listed
+        return p in journal.active_paths()
+
+    with VersionConfig.lock(installed):
+        active = journal.active_paths()
+        referenced = set()
+        for d in os.listdir(data_path):
+            p = os.path.join(data_path, d)
+            if not os.path.isdir(p) or p in active:
+                continue
+            try:
+                Packages.verify_installed_entry(p)
+                with open(os.path.join(p, 'manifest.json'), 'r') as f:
+                    referenced.add(json.load(f)['program-dir'])
+            except (InvalidManifestError, MissingFileError):
+                # its program directory is no longer referenced and goes with the orphans below
+                if in_use(p):
+                    continue
+                _discard(path, p)
+                report['broken-packages'] += 1
+        for d in os.listdir(program_path):
+            p = os.path.join(program_path, d)
+            if p in referenced or p in active or in_use(p):
+                continue
+            shutil.rmtree(p, ignore_errors=True)
+            deduplication.Store(os.path.join(installed, '.store')).release_tree(p)
+            report['orphaned-programs'] += 1
+        snapshots_path = os.path.join(installed, 'snapshots')
+        if os.path.isdir(snapshots_path):
+            snapshots = SnapshotStore(snapshots_path)
+            for refs in os.listdir(snapshots_path):
+                if not refs.endswith('.refs'):
+                    continue
+                for holder in os.listdir(os.path.join(snapshots_path, refs)):
+                    # installs pin their snapshot before creating their package directory
+                    if not os.path.isdir(os.path.join(data_path, holder)) and not in_use(os.path.join(data_path, holder)):
+                        snapshots.release(refs[:-len('.refs')], holder)
+                        report['stale-snapshots'] += 1
+        # the index is rebuilt from the manifests instead of trusting its stamp
+        try:
+            os.remove(os.path.join(installed, 'package-index.json'))
+        except FileNotFoundError:
+            pass
+        p = Packages(installed)
+        for name, version in (VersionConfig.get_config(installed) or {}).items():
+            if p.is_installed(name, version):
+                continue
+            installations = p.get_installations_of(name)
+            if installations:
+                p.configure(name, installations[0]['version'])
+            else:
+                VersionConfig.remove(installed, name)
+            report['stale-defaults'] += 1
+    return report
+
+
+@traced('search')
+def search(search_string: str, path: str = None, limit: int = None):
+    # a fresh search index answers without loading the repository itself
+    repo_path = os.path.join(path, 'repository')
+    index = load_index(search_index_path(repo_path), repo_path)
+    if index is not None:
+        return index.search(search_string, limit)
+    return Repository(repo_path).search(search_string, limit)
@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
 
+import errno
 import json
 import os
-import shutil
+from types import MappingProxyType
+
+from .fileio import exchange, write_json_atomic
+from .search import SearchIndex, build_index, load_index
+from .tracing import span, traced
+from .versions import newest, parse_requirement
 
 
 class InvalidManifestError(Exception):
@@ -13,72 +19,355 @@ class MissingFileError(Exception):
     pass
 
 
+class InvalidPackagesError(InvalidManifestError):
+
+    def __init__(self, errors: dict):
+        super().__init__(f'{len(errors)} invalid package(s)')
+        self.errors = errors
+
+
+def hash_package(path: str):
+    import hashlib
+
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            h.update(os.path.relpath(file_path, path).encode() + b'\0')
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    h.update(chunk)
+            h.update(b'\0')
+    return h.hexdigest()
+
+
+def search_index_path(path: str):
+    return os.path.normpath(path) + '.search.json'
+
+
 class Repository:
 
-    def __init__(self, path: str = None):
+    @traced('repository.load')
+    def __init__(self, path: str = None, workers: int = None):
         self._path = path or os.path.join('/opt', 'mdt', 'repository')
-        self._repo = self._load_repo()
+        self._workers = workers
+        self._index_path = os.path.normpath(self._path) + '.index.json'
+        self._search_path = search_index_path(self._path)
+        self._repo, self._meta = self._load_repo()
+        self._build_lookups()
 
     def get(self, package_name: str = None, version: str = None):
+        # entries are returned as read-only views, callers must not rely on getting a private copy
         if not package_name and not version:
-            return self._repo.copy()
+            return self._views
         elif not package_name and version is not None:
-            ret = []
-            for r in self._repo:
-                if version in r['versions']:
-                    ret.append(r)
-            return ret
+            return tuple(self._by_name[name] for name in self._by_version.get(version, ()))
         elif package_name is not None and not version:
-            for r in self._repo:
-                if r['name'] == package_name:
-                    return r.copy()
+            return self._by_name.get(package_name)
         elif package_name is not None and version is not None:
-            for r in self._repo:
-                if r['name'] == package_name and version in r['versions']:
-                    return r.copy()
+            if version in self._versions_of.get(package_name, ()):
+                return self._by_name[package_name]
+
+    def resolve(self, package_name: str, spec: str = None):
+        # maps a version spec ('latest', '>=1.2,<2', '^1.2', '~1.2' or an exact version) to the newest match;
+        # without a spec the package's default version is used
+        entry = self._by_name.get(package_name)
+        if entry is None:
+            return None
+        if not spec:
+            return entry['default-version']
+        if spec in self._versions_of[package_name]:
+            return spec
+        return newest(entry['versions'], spec)
+
+    def content_hash(self, package_name: str):
+        meta = self._meta.get(package_name)
+        if meta is None:
+            return None
+        if meta['hash'] is None:
+            meta['hash'] = hash_package(os.path.join(self._path, meta['dir']))
+        return meta['hash']
+
+    def latest(self, package_name: str):
+        return self.resolve(package_name, 'latest')
+
+    @traced('repository.search')
+    def search(self, query: str, limit: int = None):
+        index = load_index(self._search_path, self._path) or SearchIndex(build_index(self._repo))
+        return index.search(query, limit)
 
     def add(self, package: str, pack_name: str):
-        self.verify_pack(package)
+        import shutil
+
+        manifest = self.verify_pack(package)
         shutil.copytree(package, os.path.join(self._path, pack_name))
+        entry = self._load_entry(os.path.join(self._path, pack_name), manifest)
+        self._repo.append(entry)
+        self._meta[entry['name']] = {'dir': pack_name, 'hash': hash_package(package),
+                                     'stat': self._manifest_stat(os.path.join(self._path, pack_name))}
+        self._build_lookups()
+        self._write_index()
+
+    @traced('repository.update')
+    def update(self, path: str, clear: bool = False, move: bool = False):
+        # move=True renames packages out of path instead of copying them, path must be on the same filesystem
+        import shutil
+        import tempfile
 
-    def update(self, path: str, clear: bool = False):
         path = os.path.abspath(path)
         dirs = []
         for d in os.listdir(path):
-            dirs.append(os.path.join(path, d))
-        for d in dirs:
-            self.verify_pack(d)
-        if clear:
-            for di in os.listdir(self._path):
-                shutil.rmtree(os.path.join(self._path, di))
-        for d in os.listdir(self._path):
-            with open(os.path.join(self._path, d, 'manifest.json'), 'r') as f:
-                s_name = json.load(f)['name']
-            for nd in dirs:
-                with open(os.path.join(nd, 'manifest.json'), 'r') as f:
-                    if json.load(f)['name'] == s_name:
-                        shutil.rmtree(os.path.join(self._path, d))
-                        break
-        for pack in os.listdir(path):
-            shutil.copytree(os.path.join(path, pack), os.path.join(self._path, pack))
+            if os.path.isdir(os.path.join(path, d)):
+                dirs.append(os.path.join(path, d))
+        # archives may ship precomputed hashes (see export) and, for deltas, the names of removed packages;
+        # shipped hashes only pick the packages that are skipped as unchanged, the index records hashes of
+        # the bytes that actually landed in the repository
+        hashes = self._read_optional(os.path.join(path, 'hashes.json')) or {}
+        delta = self._read_optional(os.path.join(path, 'delta.json'))
+
+        def check(d):
+            # every incoming manifest is parsed once here and reused for matching and indexing
+            manifest = self.verify_pack(d)
+            return manifest, hashes.get(os.path.basename(d)) or hash_package(d)
+
+        with span('repository.verify', packages=len(dirs)):
+            checked = self._map_packages(check, dirs)
+        manifests = {}
+        incoming = {}
+        for d, (manifest, content_hash) in checked.items():
+            manifests[d] = manifest
+            incoming[manifest['name']] = (d, content_hash)
+        if delta is not None:
+            removed = set(delta['removed'])
+        elif clear:
+            removed = set(self._meta) - set(incoming)
+        else:
+            removed = set()
+        changed = set()
+        # replaced and removed packages are renamed into trash first, so every package swap is a rename;
+        # the trash is only deleted once the update went through, on failure every rename is undone
+        trash = tempfile.mkdtemp(prefix='.' + os.path.basename(os.path.normpath(self._path)) + '-old.',
+                                 dir=os.path.dirname(os.path.normpath(self._path)))
+        meta = dict(self._meta)
+        moved = []
+        placed = []
+        try:
+            if move and clear and delta is None:
+                # a full staged tree replaces the whole repository in one step
+                for extra in ('hashes.json', 'delta.json'):
+                    if os.path.isfile(os.path.join(path, extra)):
+                        os.remove(os.path.join(path, extra))
+                if self._swap(path, trash):
+                    shutil.rmtree(trash, ignore_errors=True)
+                    claimed = [os.path.join(self._path, os.path.basename(d)) for d, _ in incoming.values()
+                               if os.path.basename(d) in hashes]
+                    with span('repository.hash', packages=len(claimed)):
+                        computed = self._map_packages(hash_package, claimed)
+                    self._meta = {}
+                    for name, (d, h) in incoming.items():
+                        dst = os.path.join(self._path, os.path.basename(d))
+                        self._meta[name] = {'dir': os.path.basename(d), 'hash': computed.get(dst, h), 'stat': self._manifest_stat(dst)}
+                    self._repo = [self._load_entry(os.path.join(self._path, os.path.basename(d)), manifests[d]) for d in manifests]
+                    self._build_lookups()
+                    self._write_index()
+                    return
+                # the staged tree is on another filesystem, its packages are copied in one by one
+                move = False
+            for name in removed:
+                if name in self._meta:
+                    old = self._meta.pop(name)['dir']
+                    os.rename(os.path.join(self._path, old), os.path.join(trash, 'removed-' + old))
+                    moved.append((os.path.join(self._path, old), os.path.join(trash, 'removed-' + old)))
+            for name, (d, content_hash) in incoming.items():
+                current = self._meta.get(name)
+                if current is not None and current['hash'] == content_hash and current['dir'] == os.path.basename(d):
+                    continue
+                dst = os.path.join(self._path, os.path.basename(d))
+                staged = os.path.join(trash, 'new-' + os.path.basename(d))
+                copied = not move
+                if copied:
+                    shutil.copytree(d, staged)
+                if current is not None:
+                    os.rename(os.path.join(self._path, current['dir']), os.path.join(trash, 'old-' + current['dir']))
+                    moved.append((os.path.join(self._path, current['dir']), os.path.join(trash, 'old-' + current['dir'])))
+                try:
+                    os.rename(staged if not move else d, dst)
+                except OSError as e:
+                    if not move or e.errno != errno.EXDEV:
+                        raise
+                    shutil.copytree(d, staged)
+                    copied = True
+                    os.rename(staged, dst)
+                placed.append((dst, staged))
+                if copied or os.path.basename(d) in hashes:
+                    content_hash = hash_package(dst)
+                self._meta[name] = {'dir': os.path.basename(d), 'hash': content_hash, 'stat': self._manifest_stat(dst)}
+                changed.add(name)
+        except BaseException:
+            # new packages go back to the trash and the old ones to where they were; if that fails too
+            # the trash is left in place so nothing is lost
+            self._meta = meta
+            for dst, staged in reversed(placed):
+                os.rename(dst, staged)
+            for src, dst in reversed(moved):
+                os.rename(dst, src)
+            shutil.rmtree(trash, ignore_errors=True)
+            raise
+        shutil.rmtree(trash, ignore_errors=True)
+        self._repo = [r for r in self._repo if r['name'] not in removed and r['name'] not in changed]
+        for name in changed:
+            d = incoming[name][0]
+            self._repo.append(self._load_entry(os.path.join(self._path, os.path.basename(d)), manifests[d]))
+        self._build_lookups()
+        self._write_index()
+
+    def _swap(self, staged: str, trash: str):
+        # returns False when staged is on another filesystem than the repository
+        try:
+            exchange(staged, self._path)
+        except OSError as e:
+            if e.errno == errno.EXDEV:
+                return False
+            if e.errno not in (errno.ENOSYS, errno.EINVAL):
+                raise
+            # no atomic exchange here: two renames, the old tree is put back if the second one fails
+            old = os.path.join(trash, 'repository')
+            os.rename(self._path, old)
+            try:
+                os.rename(staged, self._path)
+            except OSError as e:
+                os.rename(old, self._path)
+                if e.errno == errno.EXDEV:
+                    return False
+                raise
+            return True
+        # the old tree now sits where the staged one was
+        os.rename(staged, os.path.join(trash, 'repository'))
+        return True
 
     def export(self, path: str):
-        shutil.copytree(self._path, os.path.join(os.path.abspath(path), 'repository'))
+        import shutil
+
+        dst = os.path.join(os.path.abspath(path), 'repository')
+        shutil.copytree(self._path, dst)
+        hashes = {}
+        for meta in self._meta.values():
+            hashes[meta['dir']] = meta['hash'] or hash_package(os.path.join(self._path, meta['dir']))
+        with open(os.path.join(dst, 'hashes.json'), 'w') as f:
+            json.dump(hashes, f, indent=2)
 
     def _load_repo(self):
-        dirs = []
+        # an indexed package is trusted while its manifest.json keeps its mtime and size, so in-place edits
+        # are picked up with one stat per package; the directory is only listed again when its own mtime
+        # changed, i.e. packages were added or removed
+        # taken before listing, so a package added during the scan makes the next load look again
+        stamp = os.stat(self._path).st_mtime_ns
+        try:
+            with open(self._index_path, 'r') as f:
+                index = json.load(f)
+            entries = {entry['name']: entry for entry in index['packages']}
+            known = {m['dir']: name for name, m in index['meta'].items()}
+            listed = index['mtime'] != stamp
+        except Exception:
+            index = {'meta': {}}
+            entries = {}
+            known = {}
+            listed = True
+        if listed:
+            dirs = [d for d in os.listdir(self._path) if os.path.isdir(os.path.join(self._path, d))]
+        else:
+            dirs = list(known)
         repo = []
-        for d in os.listdir(self._path):
-            if os.path.isdir(os.path.join(self._path, d)):
-                dirs.append(os.path.join(self._path, d))
-        for di in dirs:
+        meta = {}
+        stale = {}
+        for d in dirs:
+            name = known.get(d)
+            try:
+                manifest_stat = self._manifest_stat(os.path.join(self._path, d))
+            except OSError:
+                manifest_stat = None
+            if name is not None and manifest_stat is not None and index['meta'][name].get('stat') == manifest_stat:
+                repo.append(entries[name])
+                meta[name] = index['meta'][name]
+            else:
+                stale[os.path.join(self._path, d)] = manifest_stat
+        if not listed and not stale:
+            return repo, meta
+        with span('repository.scan', packages=len(stale)):
+            loaded = self._map_packages(self._load_entry, list(stale))
+        for di, entry in loaded.items():
+            repo.append(entry)
+            # unknown hashes make the next update replace the package once
+            meta[entry['name']] = {'dir': os.path.basename(di), 'hash': None, 'stat': stale[di]}
+        self._repo, self._meta = repo, meta
+        self._write_index(stamp)
+        return repo, meta
+
+    def _build_lookups(self):
+        self._by_name = {}
+        self._by_version = {}
+        self._versions_of = {}
+        for entry in self._repo:
+            view = MappingProxyType(entry)
+            self._by_name[entry['name']] = view
+            self._versions_of[entry['name']] = frozenset(entry['versions'])
+            for v in entry['versions']:
+                self._by_version.setdefault(v, []).append(entry['name'])
+        self._views = tuple(self._by_name.values())
+
+    @traced('repository.write-index')
+    def _write_index(self, mtime: int = None):
+        # without a stamp the index describes the repository as it is now, after this process changed it
+        try:
+            if mtime is None:
+                mtime = os.stat(self._path).st_mtime_ns
+            write_json_atomic(self._index_path, {'mtime': mtime, 'packages': self._repo, 'meta': self._meta})
+            # the search index lives in its own file so only searches pay for loading it
+            write_json_atomic(self._search_path, {'mtime': mtime, 'index': build_index(self._repo)})
+        except OSError:
+            # read-only users can still work from a fresh scan
+            pass
+
+    def _map_packages(self, func, dirs: list):
+        # manifest work is I/O bound, so threads overlap the latency of slow (network) filesystems
+        from concurrent.futures import ThreadPoolExecutor
+
+        results = {}
+        errors = {}
+        with ThreadPoolExecutor(max_workers=self._workers) as pool:
+            futures = {d: pool.submit(func, d) for d in dirs}
+        for d, future in futures.items():
+            try:
+                results[d] = future.result()
+            except Exception as e:
+                errors[d] = e
+        if errors:
+            raise InvalidPackagesError(errors)
+        return results
+
+    @staticmethod
+    def _manifest_stat(d: str):
+        st = os.stat(os.path.join(d, 'manifest.json'))
+        return [st.st_mtime_ns, st.st_size]
+
+    @staticmethod
+    def _read_optional(path: str):
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    @staticmethod
+    def _load_entry(di: str, manifest: dict = None):
+        if manifest is None:
             with open(os.path.join(di, 'manifest.json'), 'r') as f:
-                j = json.load(f)
-            j['install-script'] = os.path.join(di, j['install-script'])
-            j['remove-script'] = os.path.join(di, j['remove-script'])
-            j['start-script'] = os.path.join(di, j['start-script'])
-            repo.append(j)
-        return repo
+                manifest = json.load(f)
+        j = manifest.copy()
+        j['install-script'] = os.path.join(di, j['install-script'])
+        j['remove-script'] = os.path.join(di, j['remove-script'])
+        j['start-script'] = os.path.join(di, j['start-script'])
+        return j
 
     @staticmethod
     def verify_pack(d: str):
@@ -107,6 +396,12 @@ class Repository:
             for entry in p['versions']:
                 if not type(entry) is str:
                     raise InvalidManifestError
+            if not type(p.get('dependencies', [])) is list:
+                raise InvalidManifestError
+            for entry in p.get('dependencies', []):
+                if not type(entry) is str:
+                    raise InvalidManifestError
+                parse_requirement(entry)
         except Exception:
             raise InvalidManifestError
         if not os.path.isfile(os.path.join(d, p['install-script'])):
@@ -117,4 +412,5 @@ class Repository:
             raise MissingFileError('no start script found')
         if type(p['icon']) is str and not os.path.isfile(os.path.join(d, p['icon'])):
             raise MissingFileError('icon file is missing')
+        return p
 
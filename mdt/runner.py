@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+
+TAIL_LINES = 40
+# longer lines are cut in the tail shown on errors
+TAIL_LINE_LENGTH = 400
+CHUNK_SIZE = 64 * 1024
+LOG_SIZE = 1024 * 1024
+LOG_BACKUPS = 3
+# time a script gets to exit after SIGTERM before its process group is killed
+GRACE_PERIOD = 5
+
+
+class ScriptTimeout(Exception):
+
+    def __init__(self, timeout: float, tail: list):
+        super().__init__(f'script still running after {timeout} s')
+        self.tail = tail
+
+
+class RotatingLog:
+    # <name>.log is moved to <name>.log.1 (and so on, up to LOG_BACKUPS files) once it grows past LOG_SIZE
+
+    def __init__(self, path: str, max_size: int = LOG_SIZE, backups: int = LOG_BACKUPS):
+        self._path = path
+        self._max_size = max_size
+        self._backups = backups
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path, 'ab')
+
+    def write(self, data: bytes):
+        with self._lock:
+            if self._file.closed:
+                # output of a process the script left running in the background
+                return
+            if self._file.tell() + len(data) > self._max_size and self._file.tell() > 0:
+                self._rotate()
+            self._file.write(data)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def _rotate(self):
+        self._file.close()
+        for n in range(self._backups - 1, 0, -1):
+            if os.path.exists(f'{self._path}.{n}'):
+                os.replace(f'{self._path}.{n}', f'{self._path}.{n + 1}')
+        os.replace(self._path, f'{self._path}.1')
+        self._file = open(self._path, 'ab')
+
+
+def _emit(lines: list, prefix: bytes, log: RotatingLog, tail: deque, continued: bool = False):
+    # continued: the first line is the rest of a line that was already cut and shown in the tail
+    if not lines:
+        return
+    log.write(b''.join(prefix + line + b'\n' for line in lines))
+    for line in lines[1:] if continued else lines:
+        line = line.decode(errors='replace')
+        tail.append(line if len(line) <= TAIL_LINE_LENGTH else line[:TAIL_LINE_LENGTH] + '...')
+
+
+def _drain(stream, prefix: bytes, log: RotatingLog, tail: deque, echo=None):
+    # read in fixed-size chunks instead of lines, so a script printing one endless line cannot grow memory
+    # without bound; lines longer than CHUNK_SIZE are logged in pieces. echo is a binary stream (the
+    # terminal) that also gets every chunk as it arrives, progress bars and prompts included
+    pending = b''
+    continued = False
+    for chunk in iter(lambda: stream.read1(CHUNK_SIZE), b''):
+        if echo is not None:
+            echo.write(chunk)
+            echo.flush()
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        cut = len(pending) >= CHUNK_SIZE
+        if cut:
+            lines.append(pending)
+            pending = b''
+        _emit(lines, prefix, log, tail, continued)
+        continued = cut or (continued and not lines)
+    if pending:
+        _emit([pending], prefix, log, tail, continued)
+    stream.close()
+
+
+def _kill_group(process):
+    # scripts that fork keep running in their own process group, so the whole group is signalled
+    for sig, wait in ((signal.SIGTERM, GRACE_PERIOD), (signal.SIGKILL, None)):
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            return
+        try:
+            process.wait(wait)
+            return
+        except subprocess.TimeoutExpired:
+            continue
+
+
+def run_script(args: list, log_path: str, timeout: float = None, env: dict = None, echo: bool = False):
+    # returns (exit code, last lines of output); both pipes are drained while the script runs, so a chatty
+    # script can never block on a full pipe. With echo the output also reaches the terminal and the script
+    # may read from it
+    log = RotatingLog(log_path)
+    log.write(f'=== {time.strftime("%Y-%m-%d %H:%M:%S")} {" ".join(args)}\n'.encode())
+    tail = deque(maxlen=TAIL_LINES)
+    if echo:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    # redirected streams (e.g. io.StringIO) have no binary buffer to echo to
+    stdout = getattr(sys.stdout, 'buffer', None) if echo else None
+    stderr = getattr(sys.stderr, 'buffer', None) if echo else None
+    process = subprocess.Popen(args, stdin=None if echo else subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               env=env, start_new_session=True)
+    readers = [threading.Thread(target=_drain, args=(process.stdout, b'', log, tail, stdout), daemon=True),
+               threading.Thread(target=_drain, args=(process.stderr, b'[stderr] ', log, tail, stderr), daemon=True)]
+    for reader in readers:
+        reader.start()
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        _kill_group(process)
+        for reader in readers:
+            reader.join(1)
+        log.write(f'=== killed after {timeout} s\n'.encode())
+        log.close()
+        raise ScriptTimeout(timeout, list(tail))
+    except BaseException:
+        _kill_group(process)
+        log.close()
+        raise
+    # a background process left behind by the script may hold the pipes open, it is not waited for
+    for reader in readers:
+        reader.join(1)
+    log.write(f'=== exit code {process.returncode}\n'.encode())
+    log.close()
+    return process.returncode, list(tail)
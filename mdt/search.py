@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import re
+from bisect import bisect_left
+from collections import Counter
+
+TOKEN_PATTERN = re.compile(r'[^\W_]+(?:\.[^\W_]+)*')
+# share of the query trigrams a name must contain to count as a fuzzy match
+FUZZY_THRESHOLD = 0.5
+
+
+def tokenize(text: str):
+    return TOKEN_PATTERN.findall(text.casefold())
+
+
+def trigrams(text: str):
+    text = text.casefold()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def build_index(packages: list):
+    # posting lists and result documents are stored as strings and only decoded when a query touches them,
+    # which keeps loading the index cheap for large repositories
+    names = []
+    docs = []
+    tokens = {}
+    grams = {}
+    for doc, pack in enumerate(packages):
+        names.append(pack['name'])
+        summary = {'name': pack['name'], 'default-version': pack['default-version'], 'versions': pack['versions']}
+        if pack.get('description'):
+            summary['description'] = pack['description']
+        docs.append(json.dumps(summary))
+        text = ' '.join([pack['name'], pack.get('description') or ''] + pack['versions'])
+        for token in set(tokenize(text)):
+            tokens.setdefault(token, []).append(str(doc))
+        for gram in trigrams(pack['name']):
+            grams.setdefault(gram, []).append(str(doc))
+    return {
+        'names': names,
+        'docs': docs,
+        'tokens': {k: ' '.join(v) for k, v in tokens.items()},
+        'trigrams': {k: ' '.join(v) for k, v in grams.items()}
+    }
+
+
+def load_index(path: str, repo_path: str):
+    # returns None when the index is missing or older than the repository directory
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+        if data['mtime'] == os.stat(repo_path).st_mtime_ns:
+            return SearchIndex(data['index'])
+    except Exception:
+        pass
+    return None
+
+
+class SearchIndex:
+
+    def __init__(self, data: dict):
+        self._names = data['names']
+        self._docs = data['docs']
+        self._folded = [n.casefold() for n in self._names]
+        self._tokens = data['tokens']
+        self._sorted_tokens = sorted(self._tokens)
+        self._trigrams = data['trigrams']
+
+    def search(self, query: str, limit: int = None):
+        # returns package summaries ranked by relevance: exact, prefix and substring name matches first,
+        # then token (name, description, version) and fuzzy trigram matches
+        q = query.casefold().strip()
+        if not q:
+            return []
+        scores = Counter()
+        for token in tokenize(q):
+            i = bisect_left(self._sorted_tokens, token)
+            while i < len(self._sorted_tokens) and self._sorted_tokens[i].startswith(token):
+                weight = 3 if self._sorted_tokens[i] == token else 2
+                for doc in self._tokens[self._sorted_tokens[i]].split():
+                    scores[int(doc)] += weight
+                i += 1
+        query_grams = trigrams(q)
+        if query_grams:
+            shared = Counter(int(doc) for gram in query_grams for doc in self._trigrams.get(gram, '').split())
+            for doc, count in shared.items():
+                similarity = count / len(query_grams)
+                if similarity >= FUZZY_THRESHOLD:
+                    scores[doc] += 4 * similarity
+        else:
+            # too short for trigrams, a plain substring scan over names is cheap enough
+            for doc, name in enumerate(self._folded):
+                if q in name:
+                    scores[doc] += 1
+        for doc in list(scores):
+            name = self._folded[doc]
+            if name == q:
+                scores[doc] += 20
+            elif name.startswith(q):
+                scores[doc] += 10
+            elif q in name:
+                scores[doc] += 5
+        ranked = sorted(scores, key=lambda doc: (-scores[doc], self._folded[doc]))
+        return [json.loads(self._docs[doc]) for doc in ranked[:limit]]
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+
+from .fileio import locked
+
+
+class SnapshotStore:
+    # immutable copies of repository packages keyed by content hash; installations pin a snapshot with a
+    # marker file in <hash>.refs/ and the snapshot is removed once the last marker is gone
+
+    def __init__(self, path: str):
+        self._path = path
+
+    def pin(self, src: str, digest: str, holder: str, copy_function=shutil.copy2):
+        # digest is the hash src is expected to have, an existing snapshot of it is reused; a new snapshot
+        # is stored under the hash of the bytes that were copied, so a stale digest never labels other
+        # content. Returns the snapshot path and its actual hash
+        from .repository import hash_package
+
+        os.makedirs(self._path, exist_ok=True)
+        with locked(os.path.join(self._path, '.lock')):
+            if digest is None or not os.path.isdir(os.path.join(self._path, digest)):
+                tmp = tempfile.mkdtemp(prefix='.snapshot.', dir=self._path)
+                try:
+                    shutil.copytree(src, os.path.join(tmp, 'package'), copy_function=copy_function)
+                    digest = hash_package(os.path.join(tmp, 'package'))
+                    if not os.path.isdir(os.path.join(self._path, digest)):
+                        os.rename(os.path.join(tmp, 'package'), os.path.join(self._path, digest))
+                finally:
+                    shutil.rmtree(tmp, ignore_errors=True)
+            snapshot = os.path.join(self._path, digest)
+            os.makedirs(snapshot + '.refs', exist_ok=True)
+            open(os.path.join(snapshot + '.refs', holder), 'w').close()
+        return snapshot, digest
+
+    def release(self, digest: str, holder: str):
+        snapshot = os.path.join(self._path, digest)
+        with locked(os.path.join(self._path, '.lock')):
+            try:
+                os.remove(os.path.join(snapshot + '.refs', holder))
+            except FileNotFoundError:
+                pass
+            if os.path.isdir(snapshot + '.refs') and not os.listdir(snapshot + '.refs'):
+                shutil.rmtree(snapshot, ignore_errors=True)
+                os.rmdir(snapshot + '.refs')
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import functools
+import os
+import threading
+import time
+
+_enabled = False
+_lock = threading.Lock()
+# (name, start ns, duration ns, thread id, args) of every finished span
+_spans = []
+_started = time.perf_counter_ns()
+
+
+class _NullSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+# handed out while tracing is off, so an instrumented block costs one call and one global lookup
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+
+    def __init__(self, name: str, args: dict):
+        self._name = name
+        self._args = args
+
+    def __enter__(self):
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        with _lock:
+            _spans.append((self._name, self._start, end - self._start, threading.get_ident(), self._args))
+        return False
+
+
+def enable():
+    global _enabled, _started
+    _enabled = True
+    _started = time.perf_counter_ns()
+
+
+def enabled():
+    return _enabled
+
+
+def span(name: str, **args):
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def traced(name: str):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Span(name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def summary():
+    # per span name: calls, total and the share of the wall time since enable(); nested spans overlap
+    # their parents and spans in worker threads overlap each other, so shares can add up to more than 100%
+    wall = time.perf_counter_ns() - _started
+    totals = {}
+    with _lock:
+        for name, _, duration, _, _ in _spans:
+            calls, total = totals.get(name, (0, 0))
+            totals[name] = (calls + 1, total + duration)
+    lines = [f'{"phase":<36} {"calls":>7} {"total ms":>11} {"share":>7}']
+    for name, (calls, total) in sorted(totals.items(), key=lambda t: -t[1][1]):
+        lines.append(f'{name:<36} {calls:>7} {total / 1e6:>11.2f} {total * 100 / wall if wall else 0:>6.1f}%')
+    lines.append(f'{"wall":<36} {"":>7} {wall / 1e6:>11.2f}')
+    return '\n'.join(lines)
+
+
+def write_chrome_trace(path: str):
+    # the Trace Event Format read by chrome://tracing and Perfetto, timestamps in microseconds
+    import json
+
+    pid = os.getpid()
+    with _lock:
+        events = [{'name': name, 'cat': name.split('.')[0], 'ph': 'X', 'ts': (start - _started) / 1000,
+                   'dur': duration / 1000, 'pid': pid, 'tid': tid, 'args': args}
+                  for name, start, duration, tid, args in _spans]
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
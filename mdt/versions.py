@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import re
+
+RELEASE_PATTERN = re.compile(r'^v?(\d+(?:\.\d+)*)(.*)$')
+OPERATORS = ('>=', '<=', '==', '!=', '>', '<', '^', '~')
+REQUIREMENT_PATTERN = re.compile(r'^\s*([A-Za-z0-9_.\-]+?)\s*((?:[<>=!^~].*)?)$')
+
+
+class InvalidVersionSpec(Exception):
+    pass
+
+
+def _release(version: str, width: int):
+    m = RELEASE_PATTERN.match(version)
+    release = tuple(int(n) for n in m.group(1).split('.')) if m else ()
+    return (release + (0,) * width)[:width]
+
+
+def version_key(version: str):
+    # numeric release parts compare numerically, anything after them (-beta, .rc1) marks a pre-release
+    m = RELEASE_PATTERN.match(version)
+    if m is None:
+        return (), 0, version
+    release = tuple(int(n) for n in m.group(1).split('.'))
+    while len(release) > 1 and release[-1] == 0:
+        release = release[:-1]
+    suffix = m.group(2).lstrip('-.+')
+    return release, 0 if suffix else 1, suffix
+
+
+def _matches_one(version: str, spec: str):
+    for op in OPERATORS:
+        if spec.startswith(op):
+            target = spec[len(op):].strip()
+            break
+    else:
+        op, target = '==', spec
+    if not target:
+        raise InvalidVersionSpec(spec)
+    key = version_key(version)
+    target_key = version_key(target)
+    if op == '==':
+        return version == target or key == target_key
+    if op == '!=':
+        return not (version == target or key == target_key)
+    if op == '>=':
+        return key >= target_key
+    if op == '<=':
+        return key <= target_key
+    if op == '>':
+        return key > target_key
+    if op == '<':
+        return key < target_key
+    # ^ keeps the first release part, ~ the first two, like npm ranges
+    width = 1 if op == '^' else 2
+    return key >= target_key and _release(version, width) == _release(target, width)
+
+
+def matches(version: str, spec: str):
+    if spec in (None, '', '*', 'latest'):
+        return True
+    return all(_matches_one(version, part.strip()) for part in spec.split(','))
+
+
+def newest(versions, spec: str = None):
+    candidates = [v for v in versions if matches(v, spec)]
+    # pre-releases are only picked when nothing stable matches
+    stable = [v for v in candidates if version_key(v)[1] == 1]
+    if not candidates:
+        return None
+    return max(stable or candidates, key=version_key)
+
+
+def parse_requirement(requirement: str):
+    # 'blockbench', 'blockbench >=4.0' or 'mcreator==2023.1' -> (name, spec)
+    m = REQUIREMENT_PATTERN.match(requirement)
+    if m is None:
+        raise InvalidVersionSpec(requirement)
+    spec = m.group(2).strip() or None
+    if spec is not None:
+        matches('0', spec)
+    return m.group(1), spec
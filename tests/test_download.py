@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import contextlib
+import http.server
+import io
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.split(__file__)[0], '..')))
+
+from mdt import api
+
+BODY = bytes(range(256)) * 64
+ETAG = '"v1"'
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    # serves BODY with an ETag and single open-ended ranges ('bytes=N-'), like the release hosting does
+    ranges = True
+    requests = []
+
+    def do_GET(self):
+        Handler.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == ETAG and 'Range' not in self.headers:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start = None
+        if Handler.ranges and 'Range' in self.headers and self.headers.get('If-Range', ETAG) == ETAG:
+            start = int(self.headers['Range'][len('bytes='):].rstrip('-'))
+        if start is not None and start >= len(BODY):
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{len(BODY)}')
+            self.end_headers()
+            return
+        if start is None:
+            self.send_response(200)
+            data = BODY
+        else:
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(BODY) - 1}/{len(BODY)}')
+            data = BODY[start:]
+        self.send_header('ETag', ETAG)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        Handler.ranges = True
+        Handler.requests = []
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self._url = f'http://127.0.0.1:{self._server.server_address[1]}/repository-update.zip'
+        self._root = tempfile.TemporaryDirectory()
+        self._tmp = os.path.join(self._root.name, '.tmp')
+        os.mkdir(self._tmp)
+        self._dst = os.path.join(self._tmp, 'repository-update.zip')
+        self._api = api.Api(self._root.name)
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._root.cleanup()
+
+    def download(self, validators: dict):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return self._api._download(self._url, self._dst, validators)
+
+    def write_part(self, data: bytes):
+        with open(self._dst + '.part', 'wb') as f:
+            f.write(data)
+
+    def read_dst(self):
+        with open(self._dst, 'rb') as f:
+            return f.read()
+
+    def test_resume_with_range(self):
+        self.write_part(BODY[:1000])
+        validators = self.download({'partial': ETAG})
+        self.assertEqual(self.read_dst(), BODY)
+        self.assertEqual(validators['etag'], ETAG)
+        self.assertEqual(Handler.requests[-1]['Range'], 'bytes=1000-')
+        self.assertEqual(Handler.requests[-1]['If-Range'], ETAG)
+        self.assertFalse(os.path.exists(self._dst + '.part'))
+
+    def test_full_response_replaces_partial_file(self):
+        # a server ignoring the range answers 200, the partial file must not be prepended
+        Handler.ranges = False
+        self.write_part(b'x' * 1000)
+        self.download({'partial': ETAG})
+        self.assertEqual(self.read_dst(), BODY)
+
+    def test_changed_file_restarts_download(self):
+        self.write_part(b'x' * 1000)
+        self.download({'partial': '"v0"'})
+        self.assertEqual(self.read_dst(), BODY)
+
+    def test_unsatisfiable_range_restarts_download(self):
+        self.write_part(BODY + b'stale')
+        self.download({'partial': ETAG})
+        self.assertEqual(self.read_dst(), BODY)
+        self.assertEqual(len(Handler.requests), 2)
+        self.assertNotIn('Range', Handler.requests[-1])
+
+    def test_not_modified_leaves_tmp_untouched(self):
+        with open(self._dst, 'wb') as f:
+            f.write(b'previous download')
+        before = {name: os.stat(os.path.join(self._tmp, name)).st_mtime_ns for name in os.listdir(self._tmp)}
+        self.assertIsNone(self.download({'etag': ETAG}))
+        after = {name: os.stat(os.path.join(self._tmp, name)).st_mtime_ns for name in os.listdir(self._tmp)}
+        self.assertEqual(before, after)
+        self.assertEqual(self.read_dst(), b'previous download')
+        self.assertEqual(Handler.requests[-1]['If-None-Match'], ETAG)
+
+
+if __name__ == '__main__':
+    unittest.main()
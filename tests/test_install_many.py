@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.split(__file__)[0], '..')))
+
+from mdt import packages, repository
+
+
+def write_package(d: str, name: str, versions: list, dependencies: list = None):
+    os.makedirs(d)
+    manifest = {
+        'name': name,
+        'versions': versions,
+        'default-version': versions[-1],
+        'icon': None,
+        'install-script': 'install.py',
+        'remove-script': 'remove.py',
+        'start-script': 'start.py',
+        'add-launcher': False,
+        'dependencies': dependencies or []
+    }
+    with open(os.path.join(d, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    for script in ('install.py', 'remove.py', 'start.py'):
+        with open(os.path.join(d, script), 'w') as f:
+            f.write('import sys\n')
+
+
+class InstallManyTest(unittest.TestCase):
+
+    def setUp(self):
+        self._root = tempfile.TemporaryDirectory()
+        self._path = self._root.name
+        for d in ('repository', '.tmp', os.path.join('installed-programs', 'package-data'), os.path.join('installed-programs', 'program-data')):
+            os.makedirs(os.path.join(self._path, d))
+        with open(os.path.join(self._path, 'installed-programs', 'package-data', 'version-config.json'), 'w') as f:
+            json.dump({}, f)
+        source = os.path.join(self._path, 'source')
+        write_package(os.path.join(source, 'blockbench'), 'blockbench', ['1.0'])
+        write_package(os.path.join(source, 'plugin'), 'plugin', ['2.0'], ['blockbench'])
+        repository.Repository(os.path.join(self._path, 'repository')).update(source)
+
+    def tearDown(self):
+        self._root.cleanup()
+
+    def installed(self):
+        return sorted(e['name'] for e in packages.Packages(os.path.join(self._path, 'installed-programs')).get_all_installed())
+
+    def test_installed_root_satisfies_dependents(self):
+        packages.install('blockbench', path=self._path)
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            results = packages.install_many(['blockbench', 'plugin'], path=self._path, verbose=True)
+        self.assertIsInstance(results['blockbench'], packages.AlreadyInstalledError)
+        self.assertIsNone(results['plugin'])
+        self.assertEqual(self.installed(), ['blockbench', 'plugin'])
+        self.assertIn('blockbench 1.0: already installed', output.getvalue())
+
+    def test_unknown_root_does_not_block_the_batch(self):
+        results = packages.install_many(['missing', 'plugin'], path=self._path)
+        self.assertIsInstance(results['missing'], packages.NoInstallCandidate)
+        self.assertIsNone(results['plugin'])
+        self.assertEqual(self.installed(), ['blockbench', 'plugin'])
+
+
+if __name__ == '__main__':
+    unittest.main()